@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+from __future__ import division, print_function
+import argparse
+import gc
+import os
+import random
+import sys
+import tempfile
+import time
+from heapq import heappush, heappop
+
+from packet import DataPacket, AckPacket
+from flow import SlidingWindow
+from kernel import Kernel, CalendarQueue
+from network import Network
+from tracer import NullTracer
+
+TC2 = os.path.join(os.path.dirname(__file__), '..', 'testcases', 'tc2.txt')
+
+def rss_bytes():
+    """Resident set size of this process in bytes (Linux only)."""
+    with open('/proc/self/statm') as f:
+        pages = int(f.read().split()[1])
+    return pages * os.sysconf('SC_PAGE_SIZE')
+
+def deep_size(obj):
+    """Size of an object including its instance dictionary, if any."""
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+def bench_memory(n=200000):
+    """Memory used per in-flight data packet.
+
+    An in-flight data packet is represented by the DataPacket travelling
+    through the network and its entry in the sender's SlidingWindow.
+    Packets in flight are never released, so the free lists play no part
+    here, and __slots__ cannot be turned off at run time: the figures are
+    those of the current classes, and a baseline without slots has to be
+    measured on a checkout from before they were introduced.
+    """
+    print('object size: DataPacket {} B, AckPacket {} B'.format(
+        deep_size(DataPacket(0, 1, 2, 1, 0.0)),
+        deep_size(AckPacket(1, 0, 2, 1, 0.0))))
+
+    gc.collect()
+    before = rss_bytes()
+    window = SlidingWindow()
+    in_flight = []
+    for i in range(1, n + 1):
+        in_flight.append(DataPacket(0, 1, 2, i, 0.0))
+        window.add(i, 0.0)
+    after = rss_bytes()
+    print('resident: {:.1f} B per in-flight packet ({} packets)'.format(
+        (after - before) / n, len(window)))
+
+def bench_event_list(sizes=(1000, 10000, 100000, 1000000), n_ops=200000):
+    """Time per hold operation of the binary heap and the CalendarQueue.
+
+    A hold operation pops the next event and schedules a new one an
+    exponentially distributed time later, so the number of pending events
+    stays at the given size.
+    """
+    rng = random.Random(1)
+    for size in sizes:
+        items = [(rng.expovariate(1.0), i, None) for i in range(size)]
+        delays = [rng.expovariate(1.0) for _ in range(n_ops)]
+
+        heap = []
+        for item in items:
+            heappush(heap, item)
+        start = time.time()
+        for i, delay in enumerate(delays, size):
+            t = heappop(heap)[0]
+            heappush(heap, (t + delay, i, None))
+        heap_time = time.time() - start
+
+        calendar = CalendarQueue()
+        for item in items:
+            calendar.push(item)
+        start = time.time()
+        for i, delay in enumerate(delays, size):
+            t = calendar.pop()[0]
+            calendar.push((t + delay, i, None))
+        calendar_time = time.time() - start
+
+        print('{:8d} pending: heap {:.2f} us, calendar {:.2f} us per '
+              'hold'.format(size, heap_time / n_ops * 1.0E6,
+                            calendar_time / n_ops * 1.0E6))
+
+def scaled_network(filename, copies):
+    """Text of a network file holding <copies> disjoint copies of the
+    network in <filename>. Names of copy k get the suffix _k and the output
+    selection is dropped."""
+    sections = [[] for _ in range(4)]
+    sect_idx = 0
+    with open(filename) as f:
+        for line in f:
+            fields = line.split()
+            if not fields:
+                continue
+            if line[0] == '-':
+                sect_idx += 1
+            elif sect_idx < len(sections):
+                sections[sect_idx].append(fields)
+
+    lines = []
+    for sect_idx, section in enumerate(sections):
+        if sect_idx:
+            lines.append('-')
+        # Fields naming hosts, routers or links
+        n_names = (1, 1, 3, 3)[sect_idx]
+        for k in range(copies):
+            for fields in section:
+                lines.append(' '.join(
+                    ['{}_{}'.format(name, k) for name in fields[:n_names]] +
+                    fields[n_names:]))
+    return '\n'.join(lines) + '\n'
+
+def bench_scheduler(filename=TC2, copies=(1, 10, 50), sim_time=5.0):
+    """Run time of a scaled up network on the heap and calendar event lists.
+
+    The network in <filename> is copied <copies> times so that the number
+    of pending events grows with the number of copies.
+    """
+    for n in copies:
+        fd, path = tempfile.mkstemp(suffix='.txt')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(scaled_network(filename, n))
+            for event_list in ('heap', 'calendar'):
+                env = Kernel(event_list=event_list)
+                sim = Network(env, path, tracer=NullTracer())
+                start = time.time()
+                sim.run(sim_time)
+                print('{:4d} copies: {:8s} {:.2f} s, {} pending events at '
+                      'the end'.format(n, event_list, time.time() - start,
+                                       len(env._queue)))
+        finally:
+            os.remove(path)
+
+def main(argv=None):
+    benchmarks = {
+        'memory': bench_memory,
+        'event_list': bench_event_list,
+        'scheduler': bench_scheduler
+    }
+
+    parser = argparse.ArgumentParser(description='Run benchmarks.')
+    parser.add_argument(
+        'benchmark', nargs='?', default='memory', choices=sorted(benchmarks))
+    args = parser.parse_args(argv)
+
+    benchmarks[args.benchmark]()
+
+if __name__ == '__main__':
+    main()
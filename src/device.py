@@ -3,30 +3,41 @@ from functools import partial
 from collections import defaultdict, deque
 from operator import attrgetter
 
-import simpy
-
 from flow import SelectiveReceiver
 from packet import RoutingPacket, SonarPacket, DataPacket
+from tracer import TextTracer, IdentityNames
 
 class Device(object):
     """Superclass for Host, Router, and Link.
 
     Attributes:
         env: Simpy environment where the Device is stored.
-        dev_id: ID of the device.
-        max_degree: The maximum number of Devices that can be attached."""
+        dev_id: Integer ID of the device.
+        name: Name of the device in traces.
+        names: Sequence mapping entity IDs to their names in traces.
+        max_degree: The maximum number of Devices that can be attached.
+        tracer: Tracer object receiving the events of this device."""
 
-    def __init__(self, env, dev_id):
+    def __init__(self, env, dev_id, tracer=None, names=None):
         """
         Initiates the Device Object
 
         Args:
             env: Simpy environment
             dev_id: Device ID
+            tracer: Tracer object, defaults to text on stdout
+            names: Name table of devices and flows, defaults to using the
+                IDs as names
         """
         self.env = env
         self._dev_id = dev_id
+        self.tracer = tracer if tracer is not None else TextTracer()
+        self.names = names if names is not None else IdentityNames()
+        self.name = self.names[dev_id]
         self._ports = {}
+        # Adjacent IDs by name, and in the order the ports are flooded
+        self._port_ids = {}
+        self._port_order = []
         
     @property
     def dev_id(self):
@@ -66,6 +77,10 @@ class Device(object):
             raise Exception('Connectd to too many devices')
 
         self._ports[adj_id] = port
+        # Ports used to be keyed by name, and equal-cost routing ties
+        # depend on the order they were flooded in
+        self._port_ids[self.names[adj_id]] = adj_id
+        self._port_order = list(self._port_ids.values())
 
     def send(self, packet, to_id):
         """
@@ -79,13 +94,14 @@ class Device(object):
 
     def send_except(self, packet, except_id=None):
         """
-        Sends to all ports except a specified port
+        Sends to all ports except a specified port, in the order of a
+        dictionary keyed by their names
 
         Args:
             packet: The packet that we need to send
             except_id: The id we don't want to send to.
         """
-        for adj_id in self._ports:
+        for adj_id in self._port_order:
             if except_id is None or adj_id != except_id:
                 self.send(packet, adj_id)
 
@@ -127,20 +143,31 @@ class Host(Device):
 
     _max_degree = 1
 
-    def __init__(self, env, dev_id):
+    def __init__(
+        self, env, dev_id, tracer=None, dynamic_routing=True, names=None):
         """
         Constructor for Host object.
 
         Args:
             env: Simpy environment
             dev_id: device ID
+            tracer: Tracer object
+            dynamic_routing: Whether to explore routes periodically with
+                SonarPacket
+            names: Name table of devices and flows
         """
-        super(Host, self).__init__(env, dev_id)
+        super(Host, self).__init__(env, dev_id, tracer, names)
         self._flows = {}
         self._acker = defaultdict(SelectiveReceiver)
         self._ack_n = defaultdict(int)
         self._ack_timestamp = defaultdict(float)
-        self.env.process(self.proc_routing())
+        self._paths = {}
+        self._trace_send = {}
+        self._trace_acks = self.tracer.enabled('receive_data')
+        if dynamic_routing:
+            self._routing_version = 0
+            timer = self.env.timeout(0)
+            timer.callbacks.append(self.explore_routes)
 
     def receive(self, packet, from_id):
         """
@@ -157,56 +184,102 @@ class Host(Device):
         Add/initiate flow to Host.
         """
         self._flows[flow.id] = flow
+        flow.host = self
+        self._trace_send[flow.id] = self.tracer.enabled(
+            'send_data', flow.name, self.name)
 
-        def send_packet():
-            """Sends packets according to flow."""
-            while True:
-                packet = yield flow.next_packet.get()
-                for adj_id in self._ports:
-                    self.send(packet, adj_id)
+    def send_data(self, flow, packet):
+        """
+        Sends a data packet of <flow> into the link of this host.
+        """
+        size = packet.size
+        packet_no = packet.packet_no
 
-                print('{:.6f} send_data {} {} {} {}'.format(
-                    self.env.now, flow.id, self.dev_id, 
-                    packet.size, packet.packet_no))
+        path = packet.path
+        if path is not None and path.valid:
+            path.cables[0].feed(packet)
+        else:
+            for adj_id in self._ports:
+                self.send(packet, adj_id)
 
-        self.env.process(send_packet())
+        if self._trace_send[flow.id]:
+            self.tracer.emit(
+                'send_data', self.env.now, flow.name, self.name,
+                size, packet_no)
 
-    def get_data(self, flow_id, packet_no):
+    def get_data(self, flow_id, packet_no, count=1):
         """
         Gets acknowledgement data for packets.
-        """
-        print('{:.6f} receive_data {} {} {}'.format(
-            self.env.now, flow_id, self.dev_id, packet_no))
-        n = self._acker[flow_id](packet_no)
-        if n is not None:
-            print('{:.6f} send_ack {} {} {}'.format(
-                self.env.now, flow_id, self.dev_id, n))
+
+        Args:
+            flow_id: Flow ID of the packets
+            packet_no: Packet number of the first packet
+            count: Number of consecutive packets received
+        """
+        if self._trace_acks:
+            for i in xrange(packet_no, packet_no + count):
+                self.tracer.emit(
+                    'receive_data', self.env.now, self.names[flow_id],
+                    self.name, i)
+        if count == 1:
+            n = self._acker[flow_id](packet_no)
+        else:
+            n = self._acker[flow_id].add_range(packet_no, packet_no + count)
+        if n is not None and self._trace_acks:
+            self.tracer.emit(
+                'send_ack', self.env.now, self.names[flow_id], self.name, n)
         return n
 
-    def get_ack(self, flow_id, packet_no, timestamp):
+    def get_ack(self, flow_id, packet_no, timestamp, acks=1, gap=0.0):
         """
         Gets acknowledgement 
         """
-        print('{:.6f} receive_ack {} {} {}'.format(
-            self.env.now, flow_id, self.dev_id, packet_no))
-        self._flows[flow_id].get_ack(packet_no, timestamp)
+        if self._trace_acks:
+            self.tracer.emit(
+                'receive_ack', self.env.now, self.names[flow_id], self.name,
+                packet_no)
+        self._flows[flow_id].get_ack(packet_no, timestamp, acks, gap)
 
-    def proc_routing(self):
-        ver = 0
-        while True:
-            self.send_except(SonarPacket(self.dev_id, ver))
-            yield self.env.timeout(5)
-            ver += 1
+    def path_to(self, dest_id):
+        """Returns a valid compiled Path to host <dest_id> or None.
+
+        Args:
+            dest_id: Target host ID
+        """
+        path = self._paths.get(dest_id)
+        if path is None or not path.valid:
+            path = self._paths[dest_id] = compile_path(self, dest_id)
+        return path
+
+    def explore_routes(self, event=None):
+        """Sends a SonarPacket, and again every 5 seconds."""
+        self.send_except(SonarPacket(self.dev_id, self._routing_version))
+        self._routing_version += 1
+        timer = self.env.timeout(5)
+        timer.callbacks.append(self.explore_routes)
 
 class BufferedCable(object):
     """
     The general object for a one-way connector between objects. Includes 
         buffers for packets.
 
+    The buffer is a FIFO queue of packets whose occupancy is tracked in
+    bytes. The packet at the head of the queue is being transmitted and
+    keeps its space in the buffer until its transmission completes, so a
+    single SimPy event is scheduled per departure.
+
+    Transmitted packets then enter a delay line. Since the propagation
+    delay is the same for every packet, they leave it in FIFO order, and
+    the plain timer armed when a packet is transmitted delivers the packet
+    at the head of the line. Timers are armed at the same point as the
+    latency process of each packet used to be, so packets arriving at the
+    same instant over different cables are delivered in the same order.
+
     Attributes:
         rate: Link rate in Mbps.
         delay: Link delay in milliseconds.
         buf_size: Link buffer capacity in bytes.
+        buffer_level: Bytes currently held in the buffer.
 
     """
     def __init__(self, link, src_id):
@@ -214,85 +287,200 @@ class BufferedCable(object):
         self.link = link
 
         self.env = link.env
+        self.tracer = link.tracer
 
         self.link_id = link.dev_id
+        self.link_name = link.name
+        self.names = link.names
         self.src_id = src_id
 
         self.rate = link.rate
         self.delay = link.delay
         self.buf_size = 1000 * link.buf_size
 
-        self._packet_queue = deque()
-
-        self._buffer_level = (
-            simpy.Container(self.env, capacity=self.buf_size),
-            simpy.Container(self.env, capacity=self.buf_size)
-        )
+        self._trace_buf = self.tracer.enabled('buffer_diff', self.link_name)
+        self._trace_loss = self.tracer.enabled('packet_loss', self.link_name)
+        self._trace_tx = self.tracer.enabled('transmission', self.link_name)
 
-        self._cable = simpy.Store(self.env)
-
-        self.env.process(self._feed_cable())
+        self._packet_queue = deque()
+        self.buffer_level = 0
+        # Size of the packet train being transmitted
+        self._tail_size = 0
+        # Time the transmission under way frees its buffer space, and the
+        # sizes of the packets queued on the link at that time before it
+        # did
+        self._release_at = None
+        self._deferred = []
+        # Both cables of the link, which share its buffer trace
+        self._link_cables = link._cables
+
+        # (arrival time, packet) pairs in propagation
+        self._delay_line = deque()
 
     def feed(self, packet):
-        self.env.process(self._feed_buffer(packet))
-
-    def _feed_buffer(self, packet):
-        with self._buffer_level[0].put(packet.size) as req:
-            ret = yield req | self.env.event().succeed()
-            if req in ret:
-                self._buffer_level[1].put(packet.size)
-                self._packet_queue.append(packet)
-                print('{:06f} buffer_diff {} {}'.format(
-                    self.env.now, 
-                    self.link_id, 
-                    packet.size))
+        """Puts a packet into the buffer or drops it if there is no room.
+
+        Of a packet train that does not fit, the leading packets that fit
+        are queued and the others are dropped.
+        """
+        size = packet.size
+
+        if self.buffer_level + size > self.buf_size:
+            head = packet.split(self.buf_size - self.buffer_level)
+            if self._trace_loss and hasattr(packet, 'flow_id'):
+                for i in xrange(packet.count):
+                    self.tracer.emit(
+                        'packet_loss', self.env.now, self.link_name,
+                        self.names[packet.flow_id], packet.packet_no + i)
+            packet.release()
+            if head is None:
+                return
+            packet = head
+            size = packet.size
+
+        self.buffer_level += size
+        self._packet_queue.append(packet)
+        if self._trace_buf:
+            # Departures from the link due now are logged first, as they
+            # would have been when buffering took several events
+            due = self._due_cable()
+            if due is not None:
+                due._deferred.append(size)
             else:
-                if hasattr(packet, 'flow_id'):
-                    print('{:06f} packet_loss {} {} {}'.format(
-                        self.env.now, 
-                        self.link_id, 
-                        packet.flow_id, 
-                        packet.packet_no))
-
-    def _feed_cable(self):
-        while True:
-            yield self._buffer_level[1].get(1)
-            packet = self._packet_queue.popleft()
-            yield self._buffer_level[1].get(packet.size - 1)
+                self.tracer.emit(
+                    'buffer_diff', self.env.now, self.link_name, size)
 
-            yield self.env.timeout(packet.size * 8 / (self.rate * 1.0E6))
+        # Start transmitting if the cable was idle
+        if len(self._packet_queue) == 1:
+            self._transmit()
 
-            yield self._buffer_level[0].get(packet.size)
+    def _transmit(self):
+        """Schedules the departure of the packet at the head of the queue.
 
-            print('{:06f} buffer_diff {} {}'.format(
-                self.env.now, 
-                self.link_id, 
-                -1 * packet.size))
-
-            print('{:06f} transmission {} {}'.format(
-                self.env.now, 
-                self.link_id, 
-                packet.size))
-
-            self.env.process(self._latency(packet))
+        A packet train is forwarded the way its packets would be: the train
+        is passed on once its first packet has been sent, and releases the
+        cable when its last packet has been sent.
+        """
+        packet = self._packet_queue[0]
+        if packet.count > 1:
+            departure = self.env.timeout(
+                packet._size * 8 / (self.rate * 1.0E6))
+            departure.callbacks.append(self._depart_head)
+        else:
+            delay = packet.size * 8 / (self.rate * 1.0E6)
+            self._release_at = self.env.now + delay
+            departure = self.env.timeout(delay)
+            departure.callbacks.append(self._depart)
+
+    def _depart(self, event):
+        """Completes a transmission and starts the next one."""
+        packet = self._packet_queue.popleft()
+        self._release(packet.size)
+        self._send_on(packet)
+
+        if self._packet_queue:
+            self._transmit()
+
+    def _depart_head(self, event):
+        """Passes on a packet train once its first packet has been sent."""
+        packet = self._packet_queue[0]
+
+        # Packets leave no closer together than they arrived
+        gap = max(packet.gap, packet._size * 8 / (self.rate * 1.0E6))
+        packet.gap = gap
+
+        # The train may be split further down the path
+        self._tail_size = packet.size
+        delay = (packet.count - 1) * gap
+        self._release_at = self.env.now + delay
+        tail = self.env.timeout(delay)
+        tail.callbacks.append(self._depart_tail)
+
+        self._send_on(packet)
+
+    def _depart_tail(self, event):
+        """Completes the transmission of a packet train."""
+        self._packet_queue.popleft()
+        self._release(self._tail_size)
+
+        if self._packet_queue:
+            self._transmit()
+
+    def _release(self, size):
+        """Frees the buffer space of a transmitted packet."""
+        self.buffer_level -= size
+        self._release_at = None
+
+        if self._trace_buf:
+            self.tracer.emit(
+                'buffer_diff', self.env.now, self.link_name, -1 * size)
+
+        if self._trace_tx:
+            self.tracer.emit(
+                'transmission', self.env.now, self.link_name, size)
+
+        if self._deferred:
+            due = self._due_cable()
+            if due is not None:
+                due._deferred.extend(self._deferred)
+            else:
+                for queued in self._deferred:
+                    self.tracer.emit(
+                        'buffer_diff', self.env.now, self.link_name, queued)
+            del self._deferred[:]
+
+    def _due_cable(self):
+        """Returns a cable of the link whose transmission frees its buffer
+        space now but has not done so yet, or None."""
+        now = self.env.now
+        for cable in self._link_cables.itervalues():
+            if cable._release_at == now:
+                return cable
+        return None
+
+    def _send_on(self, packet):
+        """Puts a transmitted packet into the delay line."""
+        self._delay_line.append((self.env.now + self.delay / 1.0E3, packet))
+        timer = self.env.timeout(self.delay / 1.0E3)
+        timer.callbacks.append(self._propagate)
+
+    def _deliver(self, packet):
+        """Hands a packet to the device at the far end of the cable.
+
+        Packets following a valid compiled Path go straight to the next
+        cable, or to the target host after the last one.
+        """
+        path = packet.path
+        if path is not None and path.valid:
+            hop = packet.hop + 1
+            if hop < len(path.cables):
+                packet.hop = hop
+                path.cables[hop].feed(packet)
+            else:
+                path.dest.receive(packet, self.link_id)
+        else:
+            self.link.send_except(packet, self.src_id)
 
-    def _latency(self, packet):
-        yield self.env.timeout(self.delay / 1.0E3)
-        self.link.send_except(packet, self.src_id)
+    def _propagate(self, event):
+        """Delivers the packet at the end of the delay line."""
+        _, packet = self._delay_line.popleft()
+        self._deliver(packet)
 
 class Link(Device):
     """Full-duplex link between hosts and routers.
 
     Attributes:
-        rate: Link rate in Mbps. Do not modify.
+        rate: Link rate in Mbps. Change with configure().
         delay: Link delay in milliseconds. Do not modify.
-        buf_size: Link buffer capacity in kilobytes. Do not modify.
+        buf_size: Link buffer capacity in kilobytes. Change with
+            configure().
     """
 
     _max_degree = 2
 
-    def __init__(self, env, dev_id, rate, delay, buf_size):
-        super(Link, self).__init__(env, dev_id)
+    def __init__(
+        self, env, dev_id, rate, delay, buf_size, tracer=None, names=None):
+        super(Link, self).__init__(env, dev_id, tracer, names)
 
         self.rate = rate
         self.delay = delay
@@ -308,37 +496,107 @@ class Link(Device):
 
     def receive(self, packet, from_id):
         self._cables[from_id].feed(packet)
+
+    def configure(self, rate=None, buf_size=None):
+        """Changes the rate or buffer capacity during the simulation.
+
+        Transmissions under way complete at the old rate. Packets already
+        buffered are kept even if they exceed the new capacity.
+
+        Args:
+            rate: New link rate in Mbps, if any.
+            buf_size: New buffer capacity in kilobytes, if any.
+        """
+        if rate is not None:
+            self.rate = rate
+        if buf_size is not None:
+            self.buf_size = buf_size
+        for cable in self._cables.values():
+            cable.rate = self.rate
+            cable.buf_size = 1000 * self.buf_size
         
 class Router(Device):
     """Router creates the router objects in the network.
 
+    The tables used by SonarPacket and EchoPacket are lists indexed by
+    host ID, so hosts must be numbered from 0 to n_hosts - 1.
+
     Attributes:
         table: A dictionary mapping dest_id to link_id.
         timeTable: a dictionary that keeps track of the fastest
             time to each host.
-        table_version: A dictionary that keeps track of the
-            current versions of sonar/echo packets
-        table_forward: A dictionary for directing packets forward
-        table_reverse: A dictionary for directing packets backwards
+        table_version: A list that keeps track of the
+            current versions of sonar/echo packets, -1 if none
+        table_forward: A list for directing packets forward
+        table_reverse: A list for directing packets backwards
             (Not used for directing data packets)
     """
 
-    def __init__(self, env, dev_id):
+    def __init__(self, env, dev_id, tracer=None, n_hosts=0, names=None):
         """
         Constructor for a Router.
 
         Args:
             env: Simpy environment
             dev_id: Device ID
+            tracer: Tracer object
+            n_hosts: Number of hosts in the network
+            names: Name table of devices and flows
         """
-        super(Router, self).__init__(env, dev_id)
+        super(Router, self).__init__(env, dev_id, tracer, names)
         self.table = {}
         self.timeTable = {}
+        self._tables_shared = False
         # self.env.process(self.init_routing())
 
-        self.table_version = {}
-        self.table_reverse = {}
-        self.table_forward = {}
+        self.table_version = [-1] * n_hosts
+        self.table_reverse = [None] * n_hosts
+        self.table_forward = [None] * n_hosts
+
+        # Compiled paths relying on table_forward, by destination
+        self._paths = defaultdict(list)
+
+    def routing_snapshot(self):
+        """Returns table and timeTable for read-only use by a packet.
+
+        The dictionaries are shared rather than copied. The router switches
+        to private copies before it next changes a route, so the snapshot
+        never changes afterwards.
+        """
+        self._tables_shared = True
+        return self.table, self.timeTable
+
+    def set_route(self, dest, port_id, time):
+        """Records the port and travel time of the fastest path to dest.
+
+        Args:
+            dest: Host or router ID
+            port_id: Port to reach dest through
+            time: Travel time to dest
+        """
+        if self._tables_shared:
+            self.table = dict(self.table)
+            self.timeTable = dict(self.timeTable)
+            self._tables_shared = False
+        self.table[dest] = port_id
+        self.timeTable[dest] = time
+
+    def set_forward(self, dest, port_id):
+        """Sets the port for packets addressed to <dest>.
+
+        Compiled paths through this router towards <dest> are invalidated
+        if the port changes.
+        """
+        if self.table_forward[dest] != port_id:
+            self.table_forward[dest] = port_id
+            for path in self._paths.pop(dest, ()):
+                path.valid = False
+
+    def add_path(self, dest, path):
+        """Registers a compiled path that uses the route to <dest>."""
+        paths = self._paths[dest]
+        paths[:] = [p for p in paths if p.valid]
+        paths.append(path)
 
     def look_up(self, dest):
         """Looks up destination in table.
@@ -346,12 +604,7 @@ class Router(Device):
         Args:
             dest: Host ID
         """
-        if dest in self.table_forward:
-            return self.table_forward[dest]
-        # elif dest in self.table_reverse:
-        #     return self.table_reverse[dest]
-        else:
-            return None
+        return self.table_forward[dest]
 
     def receive(self, packet, from_id):
         """
@@ -364,3 +617,59 @@ class Router(Device):
             from_id: The port ID for which the packet arrived
         """
         packet.reach_router(self, from_id)
+
+class Path(object):
+    """Compiled chain of cables from a host to another host.
+
+    Packets carrying a valid Path are forwarded from cable to cable
+    directly instead of going through Link and Router dispatch. A Path is
+    invalidated as soon as a router on it changes its route to the target.
+
+    Attributes:
+        cables: BufferedCable objects in order from the source host.
+        dest: Target Host object.
+        valid: Whether the routes the path was compiled from still hold.
+    """
+
+    __slots__ = ('cables', 'dest', 'valid')
+
+    def __init__(self, cables, dest):
+        self.cables = cables
+        self.dest = dest
+        self.valid = True
+
+def compile_path(host, dest_id):
+    """Follows the forwarding tables from <host> to host <dest_id>.
+
+    Returns:
+        A Path registered with the routers it depends on, or None if the
+        tables do not lead to the target (yet).
+    """
+    cables = []
+    routers = []
+    device = host
+    link_id = next(iter(host._ports), None)
+    while True:
+        if link_id not in device._ports:
+            return None
+        link = device._ports[link_id]
+        cables.append(link._cables[device.dev_id])
+        device = next((
+            d for adj_id, d in link._ports.items()
+            if adj_id != device.dev_id), None)
+
+        if isinstance(device, Router):
+            if device in routers:
+                # Routing loop
+                return None
+            routers.append(device)
+            link_id = device.look_up(dest_id)
+        elif isinstance(device, Host) and device.dev_id == dest_id:
+            break
+        else:
+            return None
+
+    path = Path(cables, device)
+    for r in routers:
+        r.add_path(dest_id, path)
+    return path
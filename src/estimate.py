@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+from __future__ import division, print_function
+import argparse
+
+import numpy as np
+
+from flow import FastTCPCA
+from fluid import index_cables, route_matrices
+from network import Network
+from packet import AckPacket, DataPacket
+from tracer import NullTracer
+
+def max_min_rates(load, capacity):
+    """Max-min fair rates of flows sharing cables, by water-filling.
+
+    The rates of all flows grow together until a cable is full. The flows
+    crossing it keep their rate and the others go on growing, until every
+    flow crosses a full cable.
+
+    Args:
+        load: Array with a row per cable and a column per flow, holding
+            the bytes the cable carries per packet of the flow.
+        capacity: Rate of each cable in bytes per second.
+
+    Returns:
+        Rate of each flow in packets per second.
+    """
+    n_flows = load.shape[1]
+    x = np.zeros(n_flows)
+    frozen = ~(load > 0).any(axis=0)
+    room = capacity.astype(float)
+    while not frozen.all():
+        demand = load[:, ~frozen].sum(axis=1)
+        crossed = demand > 0
+        step = (room[crossed] / demand[crossed]).min()
+        x[~frozen] += step
+        room -= demand * step
+        full = crossed & (room <= 1.0E-9 * capacity)
+        frozen |= (load[full] > 0).any(axis=0)
+    x[~(load > 0).any(axis=0)] = np.inf
+    return x
+
+def fast_equilibrium(load, paths, capacity, alpha=FastTCPCA.alpha,
+                     tol=1.0E-6, max_iter=10000):
+    """Equilibrium of FAST TCP flows sharing cables.
+
+    At equilibrium, the window update of FastTCPCA stands still when each
+    flow keeps <alpha> packets in the buffers along its path, i.e. its
+    rate x and the queueing delay q of its path satisfy x * q = alpha, and
+    only full cables have a queue. The queueing delays of the cables are
+    found by damped Newton steps on each cable.
+
+    Args:
+        load, capacity: As for max_min_rates().
+        paths: Array with a row per cable and a column per flow, with ones
+            where the packets or the ACKs of the flow cross the cable.
+        alpha: Packets each flow keeps in the buffers.
+        tol: Largest overload or idle capacity of a queued cable allowed,
+            relative to its capacity.
+        max_iter: Largest number of iterations.
+
+    Returns:
+        (x, q): Rate of each flow in packets per second and queueing
+        delay of each cable in seconds.
+    """
+    used = (load > 0).any(axis=1)
+    q = np.where(used, 1.0E-3, 0.0)
+    for _ in range(max_iter):
+        delay = np.maximum(paths.T.dot(q), 1.0E-12)
+        x = alpha / delay
+        y = load.dot(x)
+        excess = (y - capacity) / capacity
+        if (np.abs(excess[q > 0]) < tol).all() and \
+           (excess[used] < tol).all():
+            break
+        # Change of the traffic of each cable per second of queueing
+        slope = (load[used] * (x / delay)).sum(axis=1)
+        q[used] = np.maximum(
+            q[used] + 0.5 * (y[used] - capacity[used]) / slope, 0.0)
+    return x, q
+
+def _rates_over_time(load, capacity, start, num_packets):
+    """Finish time of each flow, sending at its max-min fair rate among
+    the flows sending at the same time."""
+    n_flows = len(start)
+    finish = np.full(n_flows, np.inf)
+    left = num_packets.astype(float)
+    now = 0.0
+    while np.isinf(finish).any():
+        active = (start <= now) & np.isinf(finish)
+        pending = start[start > now]
+        next_start = pending.min() if len(pending) else np.inf
+        if not active.any():
+            now = next_start
+            continue
+        x = np.zeros(n_flows)
+        x[active] = max_min_rates(load[:, active], capacity)
+        dt = min((left[active] / x[active]).min(), next_start - now)
+        left[active] -= x[active] * dt
+        now += dt
+        finish[active & (left <= 1.0E-9 * num_packets)] = now
+    return finish
+
+def estimate(sim, at=None, alpha=FastTCPCA.alpha):
+    """Estimates the outcome of simulating a network without simulating.
+
+    The rates are those of the flows sending at once in a steady state:
+    max-min fair rates as TCP flows sharing their bottlenecks fairly would
+    reach, and the equilibrium of FAST TCP flows. Neither slow start nor
+    losses are taken into account. Flows follow the shortest paths of
+    Network.routes_to().
+
+    Args:
+        sim: Network, which need not simulate any part of itself.
+        at: Time in seconds. If given, only the flows sending at that time
+            according to the estimated finish times are considered,
+            otherwise all flows of the network file.
+        alpha: Packets each FAST TCP flow keeps in the buffers.
+
+    Returns:
+        (flows, links): Dictionaries mapping the names of the flows and
+        links to dictionaries of estimates:
+            flows: 'max_min' and 'fast' rates in Mbps, 'base_rtt' and
+                'queue_delay' of the FAST equilibrium in ms, 'window' of
+                the FAST equilibrium in packets, and 'finish', the time in
+                seconds the flow completes when all flows share their
+                bottlenecks max-min fairly, or None if it is not sending.
+            links: 'max_min' and 'fast' utilization in percent and FAST
+                'queue_delay' in ms of the busier direction, and the
+                FAST 'backlog' in KB of both directions, which exceeds the
+                buffer of a cable if 'overflow' is True.
+    """
+    cables, ends = index_cables(sim)
+    rate = np.zeros(len(cables))
+    delay = np.zeros(len(cables))
+    buf_size = np.zeros(len(cables))
+    for link_id, a, b, link_rate, link_delay, link_buf in sim._link_specs:
+        for src_id in (a, b):
+            i = cables[link_id, src_id]
+            rate[i] = link_rate * 1.0E6 / 8
+            delay[i] = link_delay / 1.0E3
+            buf_size[i] = link_buf * 1000
+
+    specs = sim._flow_specs
+    R, A = route_matrices(sim, specs, cables, ends)
+    load = R * DataPacket._size + A * AckPacket._size
+    base_rtt = \
+        R.T.dot(delay + DataPacket._size / rate) + \
+        A.T.dot(delay + AckPacket._size / rate)
+    start = np.array([spec[4] for spec in specs])
+    num_packets = np.ceil(np.array([spec[3] for spec in specs]) * 1.0E6 /
+                          DataPacket.payload_size)
+    # The last ACK returns a round trip after the last packet is sent
+    finish = _rates_over_time(load, rate, start, num_packets) + base_rtt
+
+    if at is None:
+        sending = np.ones(len(specs), dtype=bool)
+    else:
+        sending = (start <= at) & (at < finish)
+    mm = np.zeros(len(specs))
+    fast = np.zeros(len(specs))
+    mm[sending] = max_min_rates(load[:, sending], rate)
+    fast[sending], q = fast_equilibrium(
+        load[:, sending], (R + A)[:, sending], rate, alpha)
+    queue_delay = (R + A).T.dot(q)
+
+    names = sim.names
+    flows = {}
+    for i, spec in enumerate(specs):
+        flows[names[spec[0]]] = {
+            'max_min': mm[i] * DataPacket._size * 8 / 1.0E6,
+            'fast': fast[i] * DataPacket._size * 8 / 1.0E6,
+            'base_rtt': base_rtt[i] * 1.0E3,
+            'queue_delay': queue_delay[i] * 1.0E3 if sending[i] else 0.0,
+            'window': fast[i] * (base_rtt[i] + queue_delay[i]),
+            'finish': finish[i] if sending[i] else None}
+
+    mm_util = load.dot(mm) / rate
+    fast_util = load.dot(fast) / rate
+    backlog = q * rate
+    links = {}
+    for link_id, (a, b) in ends.items():
+        pair = [cables[link_id, a], cables[link_id, b]]
+        links[names[link_id]] = {
+            'max_min': mm_util[pair].max() * 100,
+            'fast': fast_util[pair].max() * 100,
+            'queue_delay': q[pair].max() * 1.0E3,
+            'backlog': backlog[pair].sum() / 1000,
+            'overflow': bool((backlog[pair] > buf_size[pair]).any())}
+    return flows, links
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Estimate the flow rates and link utilization of a '
+                    'network without simulating it.')
+    parser.add_argument('filename')
+    parser.add_argument(
+        '--at', type=float, metavar='SECONDS',
+        help='only count the flows sending at that time '
+             '(default: all flows at once)')
+    args = parser.parse_args(argv)
+
+    sim = Network(None, args.filename, tracer=NullTracer(), local=())
+    flows, links = estimate(sim, args.at)
+
+    row = '{:8s}' + ' {:>9s}' * 6
+    print(row.format(
+        'flow', 'max-min', 'FAST', 'base RTT', 'queue', 'window', 'finish'))
+    print(row.format('', 'Mbps', 'Mbps', 'ms', 'ms', 'packets', 's'))
+    for name in sorted(flows):
+        f = flows[name]
+        print(row.format(
+            name, '{:.2f}'.format(f['max_min']), '{:.2f}'.format(f['fast']),
+            '{:.1f}'.format(f['base_rtt']),
+            '{:.1f}'.format(f['queue_delay']), '{:.1f}'.format(f['window']),
+            '-' if f['finish'] is None else '{:.2f}'.format(f['finish'])))
+    print()
+    row = '{:8s}' + ' {:>9s}' * 4 + '{}'
+    print(row.format('link', 'max-min', 'FAST', 'queue', 'backlog', ''))
+    print(row.format('', '%', '%', 'ms', 'KB', ''))
+    for name in sorted(links):
+        l = links[name]
+        print(row.format(
+            name, '{:.1f}'.format(l['max_min']), '{:.1f}'.format(l['fast']),
+            '{:.1f}'.format(l['queue_delay']), '{:.1f}'.format(l['backlog']),
+            ' overflow' if l['overflow'] else ''))
+
+if __name__ == '__main__':
+    main()
@@ -1,47 +1,46 @@
 from __future__ import division, print_function
+from array import array
+from bisect import bisect_left, bisect_right
 from collections import deque, namedtuple
 from math import ceil
 import heapq
 
-import simpy
+from packet import DataPacket, AckPacket, PacketTrain
+from tracer import TextTracer, IdentityNames
 
-from packet import DataPacket, AckPacket
+class SlidingWindow(object):
+    """A generic transmission window.
 
-class PacketRecord(object):
-    """Tracking record for a sent data packet.
+    It keeps track of sent data packets by packet number, with a starting
+    packet number (offset) that can only increase. Packets are stored in a
+    ring buffer of parallel arrays whose capacity is a power of two, so
+    sliding, lookup and update are all O(1).
 
-    Attributes:
-        packet_no: Packet number starting from 1.
+    For each packet in the window it records:
         timestamp: Time when this packet was sent.
         acked: Whether this packet has been acknowledged.
         retransmit: Whether this packet is a retransmitted one.
-    """
-
-    def __init__(
-        self, packet_no, timestamp, 
-        acked=False, retransmit=False
-    ):
-        self.packet_no = packet_no
-        self.timestamp = timestamp
-        # self.expiration = expiration
-        self.acked = acked
-        self.retransmit = retransmit
-
-class SlidingWindow(object):
-    """A generic transmission window.
-
-    It is a list with possibly non-zero starting index that can only increase.
 
     Attributes:
-        offset: Index number for the first element in storage.
+        offset: Packet number of the first packet in the window.
     """
 
-    def __init__(self, first_packet=1):
+    def __init__(self, first_packet=1, capacity=64):
+        size = 1
+        while size < capacity:
+            size *= 2
         self._offset = first_packet
-        self._queue = deque()
+        self._len = 0
+        self._mask = size - 1
+        self._timestamp = array('d', [0.0]) * size
+        self._acked = bytearray(size)
+        self._retransmit = bytearray(size)
 
     def __len__(self):
-        return len(self._queue)
+        return self._len
+
+    def __contains__(self, i):
+        return 0 <= i - self._offset < self._len
 
     @property
     def offset(self):
@@ -49,50 +48,86 @@ class SlidingWindow(object):
     @offset.setter
     def offset(self, value):
         i = value - self._offset
-        s = len(self._queue)
         if i < 0:
             raise ValueError('cannot slide back')
-
-        if i < s:
-            for _ in xrange(i):
-                self._queue.popleft()
-        else:
-            self._queue.clear()
-
+        self._len = max(0, self._len - i)
         self._offset = value
-    
-    def __getitem__(self, i):
-        j = i - self._offset
-        s = len(self._queue)
-        if 0 <= j and j < s:
-            return self._queue[i - self.offset]
-        else:
-            return None
 
-    def __setitem__(self, i, x):
-        j = i - self._offset
-        s = len(self._queue)
-        if 0 <= j and j < s:
-            self._queue[j] = x
-        elif j == s:
-            self._queue.append(x)
-        else:
+    def _slot(self, i):
+        if not 0 <= i - self._offset < self._len:
+            raise IndexError('packet number not in window {}'.format(
+                (i, self._offset, self._len)))
+        return i & self._mask
+
+    def _grow(self):
+        """Doubles the capacity, keeping packet numbers in their slots."""
+        old_size = self._mask + 1
+        size = 2 * old_size
+        mask = size - 1
+        timestamp = array('d', [0.0]) * size
+        acked = bytearray(size)
+        retransmit = bytearray(size)
+        for i in xrange(self._offset, self._offset + self._len):
+            j = i & self._mask
+            k = i & mask
+            timestamp[k] = self._timestamp[j]
+            acked[k] = self._acked[j]
+            retransmit[k] = self._retransmit[j]
+        self._mask = mask
+        self._timestamp = timestamp
+        self._acked = acked
+        self._retransmit = retransmit
+
+    def add(self, i, timestamp, retransmit=False):
+        """Records that packet <i> has been sent.
+
+        A packet already in the window only has its retransmit flag
+        updated. Otherwise <i> must directly follow the last packet.
+        """
+        if i in self:
+            self._retransmit[i & self._mask] = retransmit
+            return
+        if i != self._offset + self._len:
             raise IndexError('packet number not in window {}'.format(
-                (i, j, self._offset, [p.packet_no for p in self._queue])))
+                (i, self._offset, self._len)))
+        if self._len > self._mask:
+            self._grow()
+        j = i & self._mask
+        self._timestamp[j] = timestamp
+        self._acked[j] = False
+        self._retransmit[j] = retransmit
+        self._len += 1
+
+    def timestamp(self, i):
+        """Time when packet <i> was sent."""
+        return self._timestamp[self._slot(i)]
+
+    def set_timestamp(self, i, timestamp):
+        self._timestamp[self._slot(i)] = timestamp
+
+    def acked(self, i):
+        """Whether packet <i> has been acknowledged."""
+        return bool(self._acked[self._slot(i)])
+
+    def set_acked(self, i, acked=True):
+        self._acked[self._slot(i)] = acked
+
+    def retransmitted(self, i):
+        """Whether packet <i> is a retransmitted one."""
+        return bool(self._retransmit[self._slot(i)])
 
 class BaseFlow(object):
     """Basic functionality for a TCP flow.
 
     Attributes:
         env: SimPy environment.
-        id: Flow ID.
+        id: Integer flow ID.
+        name: Name of the flow in traces.
         src: Source host ID.
         dest: Target host ID.
         data: Data amount in megabytes.
         start: Time in seconds when this flow is scheduled to start.
         num_packets: Total number of packets to be sent.
-        next_packet: simpy.Store object with packets ready for transmission
-            inside.
         window: SlidingWindow object that keeps track of send packets.
         cwnd: Congestion window size.
         timeout: Current timeout setting.
@@ -100,22 +135,52 @@ class BaseFlow(object):
         curr_rtt: The most recent round-trip time.
         ssthresh: Threshold for Slow Start -> Congestion Avoidance.
         state: Current state of congestion control.
+        tracer: Tracer object receiving the events of this flow.
+        train_size: Maximum number of new packets sent as one PacketTrain.
+            The default of 1 sends every packet on its own. Delay-based
+            algorithms such as FAST ignore it.
+        finish_time: Time when the last packet was acknowledged, or None.
+        finish_callbacks: Functions called with the flow when it finishes.
     """
 
+    train_size = 1
+
+    # Whether the algorithm may send packet trains. A train is timed and
+    # queued as a whole, which skews the RTT samples a delay-based window
+    # follows.
+    _trains = True
+
+    # Time between the packets of a train, as they reached the target
+    _train_gap = 0.0
+
+    # Congestion control states by name, set by each algorithm
+    _states = {}
+
     def __init__(
         self, env, flow_id, src_id, dest_id, data_mb, start_s, 
-        state_constr, init_state):
+        state_constr, init_state, tracer=None, names=None):
         self.env = env
+        self.tracer = tracer if tracer is not None else TextTracer()
         self.id = flow_id
+        self.name = (names if names is not None else IdentityNames())[flow_id]
         self.src = src_id
         self.dest = dest_id
         self.data = data_mb
         self.start = start_s
+        # Source Host object, set when the flow is added to it
+        self.host = None
+        self.finish_time = None
+        self.finish_callbacks = []
+
+        # Events not selected for output are skipped at the source
+        self._trace_cwnd = self.tracer.enabled('window_size', self.name)
+        self._trace_rtt = self.tracer.enabled('packet_rtt', self.name)
+        # Congestion control diagnostics (state, ssthresh, timeout, ...)
+        self._trace_cc = self.tracer.enabled('state', self.name)
 
         self.num_packets = int(ceil(
             data_mb * 1.0E6 / DataPacket.payload_size))
 
-        self.next_packet = simpy.Store(env)
         self._ret_packets = deque()
         self._packet_start = 1
         self._packet_end = self._packet_start + self.num_packets
@@ -125,13 +190,16 @@ class BaseFlow(object):
         self.window = SlidingWindow()
         self._cwnd = 1
         self._cwnd_frac = 0.0
-        self._cwnd_balance = simpy.Container(env, init=self._cwnd)
+        # Number of packets that may be sent now, and the window reduction
+        # that acknowledgements have yet to pay off before adding credit
+        self._cwnd_credit = self._cwnd
         self._cwnd_debt = 0
 
         # Timeout
         self.timeout = 1.0
         self._timer = JKTimer()
         self._alarm = None
+        self._alarm_at = None
         self._deadlines = []
         self._last_ss = 0.0
 
@@ -140,18 +208,23 @@ class BaseFlow(object):
         self.curr_rtt = 1
 
         # Dup ack counter
-        self.last_pkinfo = None
+        self._last_acked = None
         self._ndup = 0
 
         # State
         self._ssthresh = None
         self._state_constr = state_constr
         self._state = None
+        self._init_algorithm()
         self.state = init_state
 
-        # Activate main process
-        self._main_proc = self.env.process(self.proc_next_packet())
+        # Start sending at the scheduled time
+        self._started = False
         self._finished = False
+        # Timer of the pending call of send_packets(), if any
+        self._send_timer = None
+        start = self.env.timeout(self.start)
+        start.callbacks.append(self._on_start)
 
     @property
     def ssthresh(self):
@@ -159,8 +232,8 @@ class BaseFlow(object):
     @ssthresh.setter
     def ssthresh(self, value):
         self._ssthresh = value
-        print('{:.6f} ssthresh {} {:.3f}'.format(
-            self.env.now, self.id, value))
+        if self._trace_cc:
+            self.tracer.emit('ssthresh', self.env.now, self.name, value)
     
 
     @property
@@ -171,9 +244,8 @@ class BaseFlow(object):
             return None
     @state.setter
     def state(self, value):
-        if self._state is not None:
-            print('{:.6f} state {} {}'.format(
-                self.env.now, self.id, value))
+        if self._state is not None and self._trace_cc:
+            self.tracer.emit('state', self.env.now, self.name, value)
         self._state = self._state_constr[value](self, value)
     
     @property
@@ -199,16 +271,38 @@ class BaseFlow(object):
             saving = income - repayment
             self._cwnd_debt -= repayment
             if saving > 0:
-                self._cwnd_balance.put(saving)
+                self._cwnd_credit += saving
         else:
             self._cwnd_debt -= income
 
         self._cwnd = value
 
-        print('{:.6f} window_size {} {:.3f}'.format(
-            self.env.now, self.id, value + self._cwnd_frac))
-        # print('{:f} balance {} {}'.format(
-        #     self.env.now, self.id, self._cwnd_balance._level))
+        if self._trace_cwnd:
+            self.tracer.emit(
+                'window_size', self.env.now, self.name,
+                value + self._cwnd_frac)
+
+    def _init_algorithm(self):
+        """Sets up the variables of the congestion control algorithm."""
+        pass
+
+    def switch_algorithm(self, algorithm):
+        """Continues the flow with the congestion control of <algorithm>.
+
+        The window, timers, RTT estimates and packets in flight are kept.
+        The flow enters the state of the same name in the new algorithm,
+        or slow start if there is none.
+
+        Args:
+            algorithm: Subclass of BaseFlow such as TCPRenoFlow.
+        """
+        if algorithm is type(self):
+            return
+        name = self.state
+        self.__class__ = algorithm
+        self._state_constr = algorithm._states
+        self._init_algorithm()
+        self.state = name if name in algorithm._states else 'ss'
 
     def inc_balance(self, n=1):
         """Indicates that outstanding packet(s) has been acknowledged.
@@ -220,87 +314,130 @@ class BaseFlow(object):
         if self._cwnd_debt >= n:
             self._cwnd_debt -= n
         elif self._cwnd_debt > 0:
-            self._cwnd_balance.put(n - self._cwnd_debt)
+            self._cwnd_credit += n - self._cwnd_debt
             self._cwnd_debt = 0
         else:
-            self._cwnd_balance.put(n)
+            self._cwnd_credit += n
 
     def zero_debt(self):
         self._cwnd_debt = 0
 
-    def make_packet(self, packet_no):
-        """Make a data packet with the given packet number."""
-        return DataPacket(
-            self.src, self.dest, self.id, packet_no, self.env.now)
+    def make_packet(self, packet_no, count=1):
+        """Make a data packet with the given packet number, or a packet
+        train of <count> packets starting with it."""
+        path = self.host.path_to(self.dest) if self.host is not None else None
+        if count > 1:
+            gap = self._train_gap
+            train = PacketTrain(
+                self.src, self.dest, self.id, packet_no,
+                self.env.now + (count - 1) * gap, count, path)
+            train.gap = gap
+            return train
+        return DataPacket.create(
+            self.src, self.dest, self.id, packet_no, self.env.now, path)
 
     def retransmit(self, packet_no):
         """Retransmit for a packet number."""
         self._ret_packets.append(packet_no)
-        self._cwnd_balance.put(1)
+        self._cwnd_credit += 1
 
     def add_alarm(self, packet_no, cur_time, timeout):
         """Schedule a timeout event."""
         expiration = cur_time + timeout
-        heapq.heappush(self._deadlines, (expiration, packet_no, cur_time))
+        d = self._deadlines
+        heapq.heappush(d, (expiration, packet_no, cur_time))
 
-    def run_alarm(self):
-        """Reset SimPy process when the list of timeout event is updated"""
-        if (self._alarm is not None) and (not self._alarm.processed):
-            self._alarm.interrupt()
+        # Drop deadlines of packets that have left the window for good
+        if len(d) > 2 * len(self.window) + 64:
+            offset = self.window.offset
+            d[:] = [x for x in d if x[1] >= offset]
+            heapq.heapify(d)
 
+    def _prune_alarm(self):
+        """Pops deadlines that are no longer relevant off the heap."""
         d = self._deadlines
         while d:
-            pktt = self.window[d[0][1]]
-            if pktt:
-                assert pktt.packet_no == d[0][1]
-            if pktt is None or pktt.packet_no >= self.packet_cursor:
+            packet_no = d[0][1]
+            if packet_no not in self.window or \
+               packet_no >= self.packet_cursor:
                 heapq.heappop(d)
             else:
                 break
-        if d:
-            timeout = d[0][0] - self.env.now
-            assert timeout >= 0
-            self._alarm = self.env.process(self.proc_alarm(timeout))
-
-    def proc_alarm(self, timeout):
-        """SimPy process for timeout events."""
-        try:
-            yield self.env.timeout(timeout)
-
-            # Alarm expires
-            self._alarm = None
-            deadlines = self._deadlines
-            packet_no = deadlines[0][1]
-            pktt = self.window[packet_no]
-            timestamp = pktt.timestamp
-            assert pktt.packet_no == packet_no
-            assert packet_no >= self.window.offset
-            heapq.heappop(deadlines)
-
-            print('{:06f} timeout {}'.format(self.env.now, packet_no))
-
-            # Call event handler for timeout
-            self._state.event_timeout(pktt)
+        return d
 
-            self.run_alarm()
+    def run_alarm(self):
+        """Update the timer when the list of timeout event is updated.
+
+        There is a single pending timer per flow. It is only rescheduled
+        if the earliest deadline moves before it; a timer that goes off
+        too early re-arms itself for the current earliest deadline.
+        """
+        d = self._prune_alarm()
+        if d and (self._alarm_at is None or d[0][0] < self._alarm_at):
+            self._arm_alarm(d[0][0])
+
+    def _arm_alarm(self, expiration):
+        # A deadline already passed, e.g. by rounding, fires at once
+        timeout = max(0, expiration - self.env.now)
+        self._alarm_at = expiration
+        self._alarm = self.env.timeout(timeout)
+        self._alarm.callbacks.append(self._on_alarm)
+
+    def _on_alarm(self, event):
+        """Callback of the timer for timeout events."""
+        if event is not self._alarm:
+            # Superseded by an earlier timer or cancelled
+            return
+
+        expiration = self._alarm_at
+        self._alarm = self._alarm_at = None
+
+        deadlines = self._prune_alarm()
+        if not deadlines:
+            return
+        if deadlines[0][0] > expiration:
+            self._arm_alarm(deadlines[0][0])
+            return
 
-        except simpy.Interrupt:
-            pass
+        # Alarm expires
+        packet_no = deadlines[0][1]
+        timestamp = self.window.timestamp(packet_no)
+        assert packet_no >= self.window.offset
+        heapq.heappop(deadlines)
 
-    def get_ack(self, ack_no, timestamp):
+        if self._trace_cc:
+            self.tracer.emit('timeout', self.env.now, packet_no)
+
+        # Call event handler for timeout
+        self._state.event_timeout(packet_no, timestamp)
+
+        self.run_alarm()
+        self._request_send()
+
+    def get_ack(self, ack_no, timestamp, acks=1, gap=0.0):
         """Handles arrival of AckPacket.
 
+        The AckPacket of a PacketTrain stands for several acknowledgements,
+        so it counts as that many duplicates, or is passed to congestion
+        control once for each packet it newly acknowledges, up to <acks>.
+
         Args:
             ack_no: Packet number of AckPacket.
             timestamp: Time when the corresponding data packet was sent.
+            acks: Number of acknowledgements the AckPacket stands for.
+            gap: Time between arrivals of the packets of a PacketTrain.
         """
 
         if self._finished:
             return
 
         if ack_no == self._packet_end:
-            print('{:06f} finish {}'.format(self.env.now, self.id))
+            if self._trace_cc:
+                self.tracer.emit('finish', self.env.now, self.name)
+            self.finish_time = self.env.now
             self.done()
+            for callback in self.finish_callbacks:
+                callback(self)
             return
 
         packet_no = ack_no - 1
@@ -309,32 +446,34 @@ class BaseFlow(object):
         expected = self.window.offset
 
         if packet_no < expected:
-            if packet_no == self.last_pkinfo.packet_no:
+            if packet_no == self._last_acked:
                 # Dup ack
-                self._ndup += 1
-                print('{:06f} dupack {} {}'.format(
-                    self.env.now, ack_no, q[ack_no].timestamp))
-                self._state.event_dupack(q[ack_no], self._ndup)
-            return
+                sent = q.timestamp(ack_no)
+                for _ in xrange(acks):
+                    self._ndup += 1
+                    if self._trace_cc:
+                        self.tracer.emit('dupack', self.env.now, ack_no, sent)
+                    self._state.event_dupack(ack_no, sent, self._ndup)
         else:
             # Normal ack
 
             self._ndup = 0
 
-            # Locate the packet tracker
-            pktt = q[packet_no]
-            self.last_pkinfo = pktt
-            assert pktt.packet_no == packet_no
+            if acks > 1:
+                self._train_gap = gap
+
+            self._last_acked = packet_no
 
             # Mark the packet as acked
-            pktt.acked = True
+            q.set_acked(packet_no)
 
             # Update timeout
             if timestamp is not None:
-                pktt.timestamp = timestamp
-            delay = self.env.now - pktt.timestamp
-            print('{:.6f} packet_rtt {} {}'.format(
-                self.env.now, self.id, delay))
+                q.set_timestamp(packet_no, timestamp)
+            sent = q.timestamp(packet_no)
+            delay = self.env.now - sent
+            if self._trace_rtt:
+                self.tracer.emit('packet_rtt', self.env.now, self.name, delay)
             self.timeout = self._timer(delay)
 
             self.curr_rtt = delay
@@ -345,17 +484,22 @@ class BaseFlow(object):
             # Shift transmission window
             # pdiff = min(packet_no - expected + 1, len(q))
 
+            newly_acked = min(packet_no + 1, self.packet_cursor) - expected
+
             q.offset = packet_no + 1
 
             # Reset alarm
             self.run_alarm()
 
-            self._state.event_ack(pktt)
+            for _ in xrange(max(1, min(acks, newly_acked))):
+                self._state.event_ack(packet_no, sent)
 
             bal_inc = min(packet_no + 1, self.packet_cursor) - expected
 
             self.inc_balance(max(1, bal_inc))
 
+        self._request_send()
+
     def go_back(self, packet_no=None):
         """Rewinds the window for retransmission."""
         old_cur = self.packet_cursor
@@ -369,63 +513,103 @@ class BaseFlow(object):
     def done(self):
         """Stops making packets."""
         self._finished = True
-        for proc in [self._main_proc, self._alarm]:
-            if (proc is not None) and (not proc.processed):
-                proc.interrupt()
-
-    def proc_next_packet(self):
-        """SimPy process for making packets ready for transmission."""
-        yield self.env.timeout(self.start)
-
-        while True:
-            try:
-                yield self._cwnd_balance.get(1)
-            except simpy.Interrupt:
-                break
+        self._alarm = self._alarm_at = None
 
-            j = None
-            retransmit = False
+    def _on_start(self, event):
+        """Callback of the timer for the start of the flow."""
+        self._started = True
+        self._request_send()
 
-            if self._ret_packets:
-                j = self._ret_packets.popleft()
-                pktt = self.window[j]
+    def _request_send(self):
+        """Calls send_packets() once the events due now have run.
 
-                if pktt is None:
-                    continue
-
-                retransmit = True
+        Packets used to be handed to the host a few SimPy events after the
+        credit was added, so ACKs arriving at the same instant were all
+        processed before any packet left. Deferring the step by one timer
+        keeps that order, and the credit of all of them is spent at once.
+        """
+        if self._send_timer is None and self._cwnd_credit > 0:
+            self._send_timer = self.env.timeout(0)
+            self._send_timer.callbacks.append(self._on_send)
+
+    def _on_send(self, event):
+        """Callback of the timer set by _request_send()."""
+        self._send_timer = None
+        self.send_packets()
+
+    def send_packets(self):
+        """Sends as many packets as the window credit allows.
+
+        Called after every event that may add credit, so that all
+        sendable packets go into the host's link in the same step. Each
+        unit of credit is spent on a pending retransmission if any, or
+        else on the next new packet. With train_size > 1, consecutive new
+        packets are sent as packet trains, paced at the gap the last train
+        arrived with as they would be by the returning ACKs.
+        """
+        if not self._started or self._finished:
+            return
 
-            if not retransmit:
-                j = i = max(self.packet_cursor, self.window.offset)
-                if i >= self._packet_end:
-                    continue
-                self.packet_cursor = i + 1
+        window = self.window
+        sent = False
 
-            packet = self.make_packet(j)
+        while self._cwnd_credit > 0:
+            if not self._ret_packets and \
+               max(self.packet_cursor, window.offset) >= self._packet_end:
+                # Nothing left to send spends the remaining credit
+                self._cwnd_credit = 0
+                break
 
-            t = self.env.now
+            self._cwnd_credit -= 1
 
-            if retransmit:
-                print('{:.6f} retransmit {} {}'.format(
-                    self.env.now, self.id, j))
+            count = 1
 
-            if self.window[j] is None:
-                self.window[j] = PacketRecord(j, t, False, retransmit)
+            if self._ret_packets:
+                j = self._ret_packets.popleft()
+                if j not in window:
+                    continue
+                retransmit = True
             else:
-                self.window[j].retransmit = retransmit
+                j = max(self.packet_cursor, window.offset)
+                if self.train_size > 1 and self._trains:
+                    # Up to a quarter of the window per train, so that the
+                    # ACKs of earlier trains keep the path busy
+                    count = min(
+                        self.train_size, max(1, self._cwnd // 4),
+                        self._cwnd_credit + 1, self._packet_end - j)
+                    self._cwnd_credit -= count - 1
+                self.packet_cursor = j + count
+                retransmit = False
 
-            try:
-                yield self.next_packet.put(packet)
-            except simpy.Interrupt:
-                break
+            t = self.env.now
 
-            self.add_alarm(j, t, self.timeout)
+            if retransmit and self._trace_cc:
+                self.tracer.emit('retransmit', t, self.name, j)
 
+            if count == 1:
+                window.add(j, t, retransmit)
+                self.host.send_data(self, self.make_packet(j))
+                self.add_alarm(j, t, self.timeout)
+            else:
+                # The packets of a train are acknowledged together, so
+                # they are all timed from when the last one is sent
+                train = self.make_packet(j, count)
+                for i in xrange(j, j + count):
+                    window.add(i, train.timestamp)
+                self.host.send_data(self, train)
+                for i in xrange(j, j + count):
+                    self.add_alarm(i, train.timestamp, self.timeout)
+            sent = True
+
+        if sent:
             self.run_alarm()
 
 class FlowState(object):
     """State controller for congestion control algorithms.
 
+    Event handlers receive the number of the packet concerned and the time
+    when it was sent.
+
     Attributes:
         name: Name of congestion control state.
         context: The Flow object this controller belongs to.
@@ -436,13 +620,13 @@ class FlowState(object):
         self.context = context
         self.start_time = self.context.env.now
 
-    def event_timeout(self, packet_info):
+    def event_timeout(self, packet_no, timestamp):
         raise NotImplementedError()
 
-    def event_dupack(self, packet_info, ndup):
+    def event_dupack(self, packet_no, timestamp, ndup):
         raise NotImplementedError()
 
-    def event_ack(self, packet_info):
+    def event_ack(self, packet_no, timestamp):
         raise NotImplementedError()
 
 class TCPTahoeSS(FlowState):
@@ -450,11 +634,11 @@ class TCPTahoeSS(FlowState):
     def __init__(self, context, name):
         super(TCPTahoeSS, self).__init__(context, name)
 
-    def event_timeout(self, packet_info):
+    def event_timeout(self, packet_no, timestamp):
         """Handles timeout for TCP Tahoe Slow Start."""
         cont = self.context
 
-        if packet_info.timestamp >= self.start_time:
+        if timestamp >= self.start_time:
             cont.ssthresh = max(1, cont.cwnd / 2)
 
         cont.cwnd = 1
@@ -462,14 +646,14 @@ class TCPTahoeSS(FlowState):
 
         self.context.state = 'ss'
 
-    def event_dupack(self, packet_info, ndup):
+    def event_dupack(self, packet_no, timestamp, ndup):
         """Handles 3 dup ack for TCP Tahoe Slow Start."""
         if ndup == 3:
-            self.event_timeout(packet_info)
+            self.event_timeout(packet_no, timestamp)
 
-    def event_ack(self, packet_info):
+    def event_ack(self, packet_no, timestamp):
         """Updates window size for TCP Tahoe Slow Start."""
-        if packet_info.timestamp >= self.start_time:
+        if timestamp >= self.start_time:
             self.context.cwnd += 1
 
         if (self.context.ssthresh is not None and 
@@ -478,40 +662,42 @@ class TCPTahoeSS(FlowState):
 
 class TCPTahoeCA(TCPTahoeSS):
 
-    def event_ack(self, packet_info):
+    def event_ack(self, packet_no, timestamp):
         """Updates window size for TCP Tahoe Congestion Avoidance."""
         self.context.cwnd += 1 / self.context.cwnd
 
 class TCPTahoeFlow(BaseFlow):
 
-    def __init__(self, env, flow_id, src_id, dest_id, data_mb, start_s):
+    _states = {
+        'ss':   TCPTahoeSS,
+        'ca':   TCPTahoeCA }
 
-        states = {
-            'ss':   TCPTahoeSS,
-            'ca':   TCPTahoeCA }
+    def __init__(
+        self, env, flow_id, src_id, dest_id, data_mb, start_s, tracer=None,
+        names=None):
 
         super(TCPTahoeFlow, self).__init__(
             env, flow_id, src_id, dest_id, data_mb, start_s,
-            states, 'ss')
+            self._states, 'ss', tracer, names)
 
 class TCPRenoSS(TCPTahoeSS):
 
-    def event_dupack(self, packet_info, ndup):
+    def event_dupack(self, packet_no, timestamp, ndup):
         """Handles 3 dup ack for TCP Reno Slow Start."""
         cont = self.context
         if ndup >= 3:
-            if packet_info.timestamp >= self.start_time:
+            if timestamp >= self.start_time:
                 cont.ssthresh = max(1, cont.cwnd / 2)
             if cont.ssthresh is not None:
                 cont.cwnd = cont.ssthresh + ndup
             else:
                 cont.cwnd = 1
-            cont.retransmit(packet_info.packet_no)
+            cont.retransmit(packet_no)
             cont.state = 'frfr'
 
 class TCPRenoCA(TCPRenoSS):
 
-    def event_ack(self, packet_info):
+    def event_ack(self, packet_no, timestamp):
         """Updates window size for TCP Reno Congestion Avoidance."""
         self.context.cwnd += 1 / self.context.cwnd
 
@@ -521,25 +707,25 @@ class TCPRenoFRFR(FlowState):
         super(TCPRenoFRFR, self).__init__(context, name)
         self.timeout_no = 0
 
-    def event_timeout(self, packet_info):
+    def event_timeout(self, packet_no, timestamp):
         """Handles timeout for TCP Reno FR/FR."""
         cont = self.context
         
-        if packet_info.timestamp >= self.start_time:
+        if timestamp >= self.start_time:
             cont.cwnd = 1
             cont.go_back()
             cont.state = 'ss'
         else:
-            self.timeout_no = max(self.timeout_no, packet_info.packet_no)
+            self.timeout_no = max(self.timeout_no, packet_no)
 
-    def event_dupack(self, packet_info, ndup):
+    def event_dupack(self, packet_no, timestamp, ndup):
         """Handles 3 dup ack for TCP Reno FR/FR."""
         self.context.cwnd += 1
 
-    def event_ack(self, packet_info):
+    def event_ack(self, packet_no, timestamp):
         """Updates window size for TCP Reno FR/FR."""
         cont = self.context
-        if packet_info.packet_no >= self.timeout_no:
+        if packet_no >= self.timeout_no:
             cont.cwnd = cont.ssthresh
             cont.state = 'ca'
         else:
@@ -549,20 +735,27 @@ class TCPRenoFRFR(FlowState):
 
 class TCPRenoFlow(BaseFlow):
 
-    def __init__(self, env, flow_id, src_id, dest_id, data_mb, start_s):
+    _states = {
+        'ss':   TCPRenoSS,
+        'ca':   TCPRenoCA,
+        'frfr': TCPRenoFRFR }
 
-        states = {
-            'ss':   TCPRenoSS,
-            'ca':   TCPRenoCA,
-            'frfr': TCPRenoFRFR }
+    def __init__(
+        self, env, flow_id, src_id, dest_id, data_mb, start_s, tracer=None,
+        names=None):
 
         super(TCPRenoFlow, self).__init__(
             env, flow_id, src_id, dest_id, data_mb, start_s,
-            states, 'ss')
+            self._states, 'ss', tracer, names)
 
 class FastTCPCA(TCPRenoSS):
 
-    def event_ack(self, packet_info):
+    # Exp decay factor
+    gamma = 0.05
+    # Desired number of packets in buffer
+    alpha = 3
+
+    def event_ack(self, packet_no, timestamp):
         """Updates window size for FAST-TCP Congestion Avoidance."""
         cont = self.context
 
@@ -577,28 +770,31 @@ class FastTCPCA(TCPRenoSS):
 
         cont.queue_delay = cont.avg_rtt - cont.base_rtt
 
-        # Exp decay factor
-        gamma = 0.05
-        # Desired number of packets in buffer
-        alpha = 3
-        
+        gamma = self.gamma
+        alpha = self.alpha
+
         ratio = cont.base_rtt / cont.curr_rtt
         new_cwnd = (1 - gamma) * cwnd + gamma * (ratio * cwnd + alpha)
         cont.cwnd = min(2 * cwnd, new_cwnd)
 
 class FastTCPFlow(BaseFlow):
 
-    def __init__(self, env, flow_id, src_id, dest_id, data_mb, start_s):
+    _states = {
+        'ss':   FastTCPCA,
+        'ca':   FastTCPCA,
+        'frfr': TCPRenoFRFR }
 
-        states = {
-            'ss':   FastTCPCA,
-            'ca':   FastTCPCA,
-            'frfr': TCPRenoFRFR }
+    _trains = False
+
+    def __init__(
+        self, env, flow_id, src_id, dest_id, data_mb, start_s, tracer=None,
+        names=None):
 
         super(FastTCPFlow, self).__init__(
             env, flow_id, src_id, dest_id, data_mb, start_s,
-            states, 'ss')
+            self._states, 'ss', tracer, names)
 
+    def _init_algorithm(self):
         # Average RTT
         self.avg_rtt = None
 
@@ -613,9 +809,9 @@ class CubicTCPSS(TCPRenoSS):
             context.w_max = context.ssthresh * 2
         context.cubic_thresh = context.w_max * (1 - context.beta)
 
-    def event_ack(self, packet_info):
+    def event_ack(self, packet_no, timestamp):
         """Updates window size for CUBIC-TCP Slow Start."""
-        if packet_info.timestamp >= self.start_time:
+        if timestamp >= self.start_time:
             self.context.cwnd += 1
 
         if self.context.cwnd >= self.context.cubic_thresh:
@@ -623,7 +819,7 @@ class CubicTCPSS(TCPRenoSS):
 
 class CubicTCPCA(CubicTCPSS):
 
-    def event_ack(self, packet_info):
+    def event_ack(self, packet_no, timestamp):
         """Updates window size for CUBIC-TCP Congestion Avoidance."""
 
         cont = self.context
@@ -642,54 +838,120 @@ class CubicTCPCA(CubicTCPSS):
         cont.cwnd = max(1, c * (t - k) ** 3 + w_max)
 
 class CubicTCPFlow(BaseFlow):
-    def __init__(self, env, flow_id, src_id, dest_id, data_mb, start_s):
-        states = {
-            'ss':   CubicTCPSS,
-            'ca':   CubicTCPCA,
-            'frfr': TCPRenoFRFR }
 
-        # Constants
-        # Scaling factor for window update
-        self.c = .4
-        # multiplication decrease factor at the time of loss event
-        self.beta = .8
+    _states = {
+        'ss':   CubicTCPSS,
+        'ca':   CubicTCPCA,
+        'frfr': TCPRenoFRFR }
 
-        self.w_max = 160
+    # Constants
+    # Scaling factor for window update
+    c = .4
+    # multiplication decrease factor at the time of loss event
+    beta = .8
+    # Window size before the first loss event
+    init_w_max = 160
 
+    def __init__(
+        self, env, flow_id, src_id, dest_id, data_mb, start_s, tracer=None,
+        names=None):
         super(CubicTCPFlow, self).__init__(
             env, flow_id, src_id, dest_id, data_mb, start_s,
-            states, 'ss')
+            self._states, 'ss', tracer, names)
+
+    def _init_algorithm(self):
+        self.w_max = self.init_w_max
 
 class SelectiveReceiver(object):
-    """Used by the client-side of flow to find the ack number."""
+    """Used by the client-side of flow to find the ack number.
+
+    Packets received out of order are kept as a sorted list of disjoint
+    half-open ranges [start, end) of packet numbers, so a burst of losses
+    costs one entry per hole rather than one per packet. Ranges are found
+    by bisection in O(log k) for k ranges, but inserting, merging or
+    removing one shifts the lists and costs O(k). k is bounded by the
+    number of holes in the window, which is small enough for the memmove
+    to beat any tree written in Python.
+    """
     def __init__(self, first_no=1):
         # All packets with packet_no < expected have been received
         self._expected = first_no
-        # Packet numbers not received in order
-        self._partial = []
+        # Ranges received beyond the first missing packet
+        self._starts = []
+        self._ends = []
+
+    @property
+    def expected(self):
+        """Packet number of the first missing packet."""
+        return self._expected
+
+    def blocks(self):
+        """Ranges (start, end) received out of order, SACK style."""
+        return list(zip(self._starts, self._ends))
+
+    def add_range(self, start, end):
+        """Records packets <start> to <end> - 1 as received.
+
+        Returns:
+            The ack number, or None if all of the packets had been
+            received in order before, just like calling with one packet.
+        """
+        expected = self._expected
+        if end <= expected:
+            return None
+        start = max(start, expected)
+        starts = self._starts
+        ends = self._ends
+
+        # Merge with the ranges overlapping or adjoining [start, end)
+        i = bisect_left(ends, start)
+        j = bisect_right(starts, end)
+        if i < j:
+            start = min(start, starts[i])
+            end = max(end, ends[j - 1])
+        starts[i:j] = [start]
+        ends[i:j] = [end]
+
+        if starts[0] == expected:
+            self._expected = ends[0]
+            del starts[0]
+            del ends[0]
+        return self._expected
 
     def __call__(self, n):
         expected = self._expected
-        partial = self._partial
+        starts = self._starts
+        ends = self._ends
 
         if n < expected:
             return None
         elif n == expected:
             expected += 1
-            while partial:
-                if partial[0] < expected:
-                    heapq.heappop(partial)
-                elif partial[0] == expected:
-                    expected += 1
-                    heapq.heappop(partial)
-                elif partial[0] > expected:
-                    break
+            if starts and starts[0] == expected:
+                expected = ends[0]
+                del starts[0]
+                del ends[0]
             self._expected = expected
             return expected
 
         else:
-            heapq.heappush(self._partial, n)
-            self._expected = expected
+            i = bisect_right(starts, n)
+            if i > 0 and n < ends[i - 1]:
+                # Already received
+                return expected
+            join_left = i > 0 and ends[i - 1] == n
+            join_right = i < len(starts) and starts[i] == n + 1
+            if join_left and join_right:
+                ends[i - 1] = ends[i]
+                del starts[i]
+                del ends[i]
+            elif join_left:
+                ends[i - 1] = n + 1
+            elif join_right:
+                starts[i] = n
+            else:
+                starts.insert(i, n)
+                ends.insert(i, n + 1)
             return expected
 
 class JKTimer(object):
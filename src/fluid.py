@@ -0,0 +1,437 @@
+#!/usr/bin/env python
+from __future__ import division, print_function
+import argparse
+import sys
+
+import numpy as np
+
+from flow import (
+    TCPTahoeFlow, TCPRenoFlow, FastTCPFlow, FastTCPCA, CubicTCPFlow)
+from metrics import MetricBin, MetricCollector
+from network import Network, alg_dict
+from packet import AckPacket, DataPacket
+
+def index_cables(topo):
+    """Numbers the cables, i.e. directions, of all links of a Network.
+
+    Cable 2 * i goes from the first to the second end of link i of the
+    network file, cable 2 * i + 1 the other way.
+
+    Returns:
+        (cables, ends): Dictionary mapping (link ID, source ID) pairs to
+        cable numbers, and dictionary mapping link IDs to the IDs of
+        their two ends.
+    """
+    cables = {}
+    ends = {}
+    for link_id, a, b, _, _, _ in topo._link_specs:
+        ends[link_id] = (a, b)
+        for src_id in (a, b):
+            cables[link_id, src_id] = len(cables)
+    return cables, ends
+
+def route_matrices(topo, flow_specs, cables, ends):
+    """Cables on the shortest paths of Network.routes_to() of some flows.
+
+    Args:
+        topo: Network.
+        flow_specs: Entries of Network._flow_specs.
+        cables, ends: As returned by index_cables().
+
+    Returns:
+        (R, A): Arrays with a row per cable and a column per flow, with
+        ones where the cable carries the packets (R) or the ACKs (A) of
+        the flow.
+    """
+    ports = {}
+    R = np.zeros((len(cables), len(flow_specs)))
+    A = np.zeros((len(cables), len(flow_specs)))
+    for i, spec in enumerate(flow_specs):
+        src, dest = spec[1:3]
+        for a, b, matrix in ((src, dest, R), (dest, src, A)):
+            if b not in ports:
+                ports[b] = topo.routes_to(b)
+            x = a
+            while x != b:
+                if x not in ports[b]:
+                    raise ValueError('No route from {} to {}'.format(
+                        topo.names[a], topo.names[b]))
+                link_id = ports[b][x]
+                matrix[cables[link_id, x], i] = 1
+                x = ends[link_id][x == ends[link_id][0]]
+    return R, A
+
+class FlowModel(object):
+    """Fluid model of the windows of a set of flows, as NumPy arrays.
+
+    A flow sends its window per round trip time, which is the propagation
+    and transmission delay of its path and of the path of its ACKs plus
+    the queueing delay of the buffers along them. A flow reacts to at most
+    one loss event per round trip. The windows follow fluid versions of
+    the algorithms of flow.py, with the same parameters:
+
+        TCPTahoeFlow, TCPRenoFlow: one packet per ACK in slow start and
+            one per window in congestion avoidance. A loss event halves
+            the window (Reno) or restarts slow start (Tahoe).
+        FastTCPFlow: gamma * (base_rtt / rtt * w + alpha - w) per ACK, with
+            gamma and alpha of FastTCPCA. A loss event halves the window.
+        CubicTCPFlow: slow start up to (1 - beta) * w_max, then the cubic
+            c * (t - K) ** 3 + w_max of the time t since the last loss
+            event, which sets w_max to the window at that time.
+
+    Attributes:
+        algorithm: Flow class whose fluid model is integrated.
+        dt: Time step in seconds.
+        base_rtt: Round trip time of each flow without queueing.
+        window: Window size of each flow in packets.
+        sent: Packets sent by each flow so far.
+        num_packets: Packets each flow has to send.
+        finish_time: Time the ACK of the last packet of each flow
+            returns, one round trip after the packet was sent, or NaN
+            until the packet is sent.
+    """
+
+    # Fluid model of each flow algorithm
+    _models = {
+        TCPTahoeFlow: '_tahoe',
+        TCPRenoFlow: '_reno',
+        FastTCPFlow: '_fast',
+        CubicTCPFlow: '_cubic'
+    }
+
+    def __init__(self, algorithm, flow_specs, R, A, delay, rate, dt):
+        """
+        Args:
+            algorithm: Flow class such as TCPRenoFlow.
+            flow_specs: Entries of Network._flow_specs.
+            R, A: Routing matrices as returned by route_matrices().
+            delay: Propagation delay of each cable in seconds.
+            rate: Rate of each cable in bytes per second.
+            dt: Time step in seconds.
+        """
+        if algorithm not in self._models:
+            raise ValueError(
+                'No fluid model of {}'.format(algorithm.__name__))
+        if dt <= 0:
+            raise ValueError('Time step must be positive')
+        self.algorithm = algorithm
+        self._update = getattr(self, self._models[algorithm])
+        self.dt = dt
+        self._R = R
+        self._A = A
+        self._RA = R + A
+
+        self.base_rtt = \
+            R.T.dot(delay + DataPacket._size / rate) + \
+            A.T.dot(delay + AckPacket._size / rate)
+        self._start = np.array([spec[4] for spec in flow_specs])
+        self.num_packets = np.ceil(np.array(
+            [spec[3] for spec in flow_specs]) * 1.0E6 /
+            DataPacket.payload_size)
+
+        n_flows = len(flow_specs)
+        self.window = np.ones(n_flows)
+        self.sent = np.zeros(n_flows)
+        self.finish_time = np.full(n_flows, np.nan)
+        # Packets lost since the last loss event, and its time
+        self._lost = np.zeros(n_flows)
+        self._last_loss = np.full(n_flows, -np.inf)
+        self._ssthresh = np.full(n_flows, np.inf)
+        # CUBIC: whether in congestion avoidance, and since when
+        self._cubic_ca = np.zeros(n_flows, dtype=bool)
+        self._epoch = np.zeros(n_flows)
+        self._w_max = np.full(n_flows, float(CubicTCPFlow.init_w_max))
+
+    def rates(self, now, queue_delay):
+        """Sending rates of the flows at time <now>.
+
+        Args:
+            now: Current simulation time in seconds.
+            queue_delay: Queueing delay of each cable in seconds.
+
+        Returns:
+            (active, x, rtt): Whether each flow is sending, its rate in
+            packets per second, down to the packets it has left, and its
+            round trip time.
+        """
+        active = self.sending(now)
+        rtt = self.base_rtt + self._RA.T.dot(queue_delay)
+        x = np.where(active, self.window / rtt, 0.0)
+        x = np.minimum(x, (self.num_packets - self.sent) / self.dt)
+        return active, x, rtt
+
+    def sending(self, now):
+        """Whether each flow has started and has packets left to send at
+        time <now>."""
+        return (self._start <= now) & np.isnan(self.finish_time)
+
+    def next_start(self, now):
+        """Earliest start time after <now> of the flows, or infinity."""
+        pending = self._start[self._start > now]
+        return pending.min() if len(pending) else np.inf
+
+    def load(self, x):
+        """Bytes per second the flows send into each cable at rates <x>,
+        packets and ACKs."""
+        return (
+            self._R.dot(x) * DataPacket._size +
+            self._A.dot(x) * AckPacket._size)
+
+    def advance(self, now, active, x, rtt, drop_ratio):
+        """Moves the flows one time step forward.
+
+        Args:
+            now: Simulation time at the start of the step.
+            active, x, rtt: As returned by rates().
+            drop_ratio: Fraction of the traffic each cable dropped during
+                the step.
+        """
+        dt = self.dt
+        # Packets of each flow lost per second
+        loss = x * self._R.T.dot(drop_ratio)
+        self.sent += x * dt
+        done = active & (self.sent >= self.num_packets - 1.0E-6)
+        self.finish_time[done] = now + dt + rtt[done]
+        # Losses within a round trip of a loss event belong to that event
+        self._lost = np.where(
+            now - self._last_loss < rtt, 0.0, self._lost + loss * dt)
+        event = active & (self._lost >= 1)
+        self._lost[event] = 0.0
+        self._last_loss[event] = now
+        self._update(now, active, x - loss, rtt, event)
+
+    def _reno(self, now, active, acks, rtt, event, tahoe=False):
+        w = self.window
+        ss = w < self._ssthresh
+        w += np.where(ss, acks, acks / w) * self.dt
+        self._ssthresh[event] = np.maximum(1, w[event] / 2)
+        w[event] = 1 if tahoe else self._ssthresh[event]
+
+    def _tahoe(self, now, active, acks, rtt, event):
+        self._reno(now, active, acks, rtt, event, tahoe=True)
+
+    def _fast(self, now, active, acks, rtt, event):
+        w = self.window
+        gamma = FastTCPCA.gamma
+        target = self.base_rtt / rtt * w + FastTCPCA.alpha
+        w += np.minimum(acks * gamma * (target - w) * self.dt, w)
+        self._ssthresh[event] = np.maximum(1, w[event] / 2)
+        w[event] = self._ssthresh[event]
+
+    def _cubic(self, now, active, acks, rtt, event):
+        w = self.window
+        c = CubicTCPFlow.c
+        beta = CubicTCPFlow.beta
+        ss = active & ~self._cubic_ca
+        w[ss] += acks[ss] * self.dt
+        start_ca = ss & (w >= self._w_max * (1 - beta))
+        self._w_max[event] = w[event]
+        start_ca |= event
+        self._cubic_ca |= start_ca
+        self._epoch[start_ca] = now
+
+        ca = active & self._cubic_ca
+        k = (self._w_max[ca] * beta / c) ** (1 / 3.0)
+        t = now - self._epoch[ca]
+        w[ca] = np.maximum(1, c * (t - k) ** 3 + self._w_max[ca])
+
+class FluidNetwork(object):
+    """Fluid approximation of a network file, integrated with NumPy.
+
+    Instead of simulating packets, every flow is described by its window
+    size, following FlowModel, and every cable, i.e. direction of a link,
+    by the occupancy of its buffer. All of them are stepped forward in
+    time together as NumPy arrays, so the cost of a step hardly depends on
+    the number of packets in flight. A buffer fills at the rate its
+    traffic exceeds the rate of the link and drops the excess once full.
+
+    Flows follow the shortest paths of Network.routes_to(), as with static
+    routing. The series of the output selection are collected into the
+    bins of a MetricCollector, averaged over time where process.py
+    averages over events, so they can be compared with those of a packet
+    level simulation.
+
+    Attributes:
+        now: Current simulation time in seconds.
+        dt: Time step in seconds.
+        tracer: MetricCollector the series are collected by.
+        names: Names of the hosts, routers, links and flows by ID, like
+            Network.names.
+        output_sel: Output selection of the network file.
+        flows: FlowModel of all flows of the network file.
+        queue: Buffer occupancy of each cable in bytes.
+    """
+
+    def __init__(
+        self, filename, algorithm=FastTCPFlow, tracer=None, dt=1.0E-3,
+        link_params=None):
+        """Reads the network file <filename>, or standard input if None.
+
+        <link_params> overrides link parameters like for Network.
+        """
+        if tracer is None:
+            tracer = MetricCollector()
+        self.tracer = tracer
+        self.now = 0.0
+        self.dt = dt
+
+        topo = Network(
+            None, filename, tracer=tracer, local=(), link_params=link_params)
+        self.names = topo.names
+        self.output_sel = topo.output_sel
+        names = self.names
+
+        cables, ends = index_cables(topo)
+        rate = np.zeros(len(cables))
+        delay = np.zeros(len(cables))
+        buf_size = np.zeros(len(cables))
+        for link_id, a, b, link_rate, link_delay, link_buf in \
+            topo._link_specs:
+            for src_id in (a, b):
+                i = cables[link_id, src_id]
+                rate[i] = link_rate * 1.0E6 / 8
+                delay[i] = link_delay / 1.0E3
+                buf_size[i] = link_buf * 1000
+        self._rate = rate
+        self._buf_size = buf_size
+
+        R, A = route_matrices(topo, topo._flow_specs, cables, ends)
+        self.flows = FlowModel(
+            algorithm, topo._flow_specs, R, A, delay, rate, dt)
+        self.queue = np.zeros(len(cables))
+        self._n_steps = 0
+
+        # Selected entities as (name, index) pairs: flows index the flow
+        # arrays, links the first of their two cables
+        flow_idx = dict(
+            (names[spec[0]], i) for i, spec in enumerate(topo._flow_specs))
+        link_idx = dict(
+            (names[link_id], cables[link_id, ends[link_id][0]])
+            for link_id in ends)
+        host_flows = {}
+        for i, spec in enumerate(topo._flow_specs):
+            host_flows.setdefault(names[spec[1]], []).append(i)
+        sel = lambda metric, idx: [
+            (name, idx[name]) for name in self.output_sel.get(metric, ())
+            if name in idx]
+        self._sel = dict(
+            (metric, sel(metric, flow_idx)) for metric in (
+                'flow_send_rate', 'packet_rtt', 'window_size'))
+        self._sel.update(
+            (metric, sel(metric, link_idx)) for metric in (
+                'link_flow_rate', 'buf_level', 'packet_loss_rate'))
+        self._sel['host_send_rate'] = sel('host_send_rate', host_flows)
+
+        # Time integrals of the current bin
+        self._bin_key = None
+        self._reset_bin()
+
+    def _reset_bin(self):
+        n_flows = len(self.flows.window)
+        n_cables = len(self.queue)
+        self._acc_sent = np.zeros(n_flows)
+        self._acc_active = np.zeros(n_flows)
+        self._acc_rtt = np.zeros(n_flows)
+        self._acc_window = np.zeros(n_flows)
+        self._acc_served = np.zeros(n_cables)
+        self._acc_dropped = np.zeros(n_cables)
+        self._acc_queue = np.zeros(n_cables)
+        self._acc_time = 0.0
+
+    def _flush_bin(self):
+        """Adds the integrals of the current bin to the bin of the tracer
+        with the same key."""
+        if self._bin_key is None or not self._acc_time:
+            return
+        bins = self.tracer.bins
+        if not bins or bins[-1].key != self._bin_key:
+            bins.append(MetricBin(self._bin_key))
+        b = bins[-1]
+        sel = self._sel
+
+        for name, i in sel['flow_send_rate']:
+            b.flow_send_sum[name] += self._acc_sent[i] * DataPacket._size
+        for name, flows in sel['host_send_rate']:
+            b.host_send_sum[name] += \
+                self._acc_sent[flows].sum() * DataPacket._size
+        for name, i in sel['packet_rtt']:
+            if self._acc_active[i]:
+                b.packet_rtt_sum[name] += self._acc_rtt[i]
+                b.packet_rtt_count[name] += self._acc_active[i]
+        for name, i in sel['window_size']:
+            if self._acc_active[i]:
+                b.window_size_sum[name] += self._acc_window[i]
+                b.window_size_count[name] += self._acc_active[i]
+        # Both cables of a link add up, like in the trace of a link
+        for name, i in sel['link_flow_rate']:
+            b.link_flow_sum[name] += self._acc_served[i:i + 2].sum()
+        for name, i in sel['packet_loss_rate']:
+            b.packet_loss_sum[name] += \
+                self._acc_dropped[i:i + 2].sum() / DataPacket._size
+        for name, i in sel['buf_level']:
+            b.buffer_level_sum[name] += self._acc_queue[i:i + 2].sum()
+            b.buffer_level_count[name] += self._acc_time
+        self._reset_bin()
+
+    def _step(self):
+        """Advances the simulation by one time step."""
+        dt = self.dt
+        now = self.now
+        flows = self.flows
+
+        active, x, rtt = flows.rates(now, self.queue / self._rate)
+        arrived = flows.load(x) * dt
+        level = self.queue + arrived - self._rate * dt
+        dropped = np.maximum(level - self._buf_size, 0.0)
+        queue = np.clip(level, 0.0, self._buf_size)
+        served = self.queue + arrived - dropped - queue
+        self.queue = queue
+        flows.advance(
+            now, active, x, rtt, dropped / np.maximum(arrived, 1.0E-12))
+
+        self._acc_sent += x * dt
+        self._acc_active += active * dt
+        self._acc_rtt += np.where(active, rtt, 0.0) * dt
+        self._acc_window += np.where(active, flows.window, 0.0) * dt
+        self._acc_served += served
+        self._acc_dropped += dropped
+        self._acc_queue += queue * dt
+        self._acc_time += dt
+        self._n_steps += 1
+        self.now = self._n_steps * dt
+
+    def run(self, until):
+        """Integrates the model until time <until> in seconds."""
+        freq = self.tracer.freq
+        for _ in range(int(round((until - self.now) / self.dt))):
+            # Bin by the time rounded to microseconds, like MetricCollector
+            key = int(freq * round(self.now, 6))
+            if key != self._bin_key:
+                self._flush_bin()
+                self._bin_key = key
+            self._step()
+        self._flush_bin()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Simulate the fluid model of a network and write its '
+                    'metrics like process.py.')
+    parser.add_argument('filename')
+    parser.add_argument('sim_time', type=float)
+    parser.add_argument(
+        'flow_alg', nargs='?', default='fast', choices=sorted(alg_dict))
+    parser.add_argument(
+        'freq', nargs='?', default=5, type=int, help='bins per second')
+    parser.add_argument(
+        '--dt', default=1.0E-3, type=float, metavar='SECONDS',
+        help='time step')
+    args = parser.parse_args(argv)
+
+    tracer = MetricCollector(sys.stdout, args.freq)
+    sim = FluidNetwork(
+        args.filename, alg_dict[args.flow_alg], tracer=tracer, dt=args.dt)
+    sim.run(args.sim_time)
+    tracer.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,308 @@
+from __future__ import division, print_function
+
+import numpy as np
+
+from device import BufferedCable
+from fluid import FlowModel, index_cables, route_matrices
+from packet import DataPacket
+
+class SharedCable(BufferedCable):
+    """BufferedCable whose buffer and capacity are shared with fluid
+    background traffic.
+
+    The buffer is one fluid queue fed by the background flows and by the
+    bytes of the packets fed to the cable, which FluidBackground moves
+    forward in time steps. A packet is dropped in the proportion of the
+    traffic the queue dropped during the last step, or else waits for the
+    backlog of the queue to be transmitted before it is transmitted
+    itself, in FIFO order with the other packets.
+
+    While the steps are paused, the cable is a plain FIFO queue of
+    packets instead, which drops the packets that do not fit into its
+    buffer and traces their bytes as buffer changes.
+
+    The state of the fluid queue is kept in the arrays of the
+    FluidBackground, at the index of the cable, so that a step needs no
+    loop over cables. buffer_level is the bytes in the buffer, background
+    traffic included.
+    """
+
+    def __init__(self, link, src_id, background, index):
+        self._background = background
+        self._index = index
+        # Bytes of the packets queued while the steps were paused
+        self._held = 0
+        super(SharedCable, self).__init__(link, src_id)
+        # Bytes owed to the losses, dropped once a packet's worth
+        self._drop_credit = 0.0
+        self._last_departure = 0.0
+
+    @property
+    def buffer_level(self):
+        return float(self._background.level[self._index]) + self._held
+
+    @buffer_level.setter
+    def buffer_level(self, value):
+        self._background.level[self._index] = value - self._held
+
+    def _drop(self, packet):
+        if self._trace_loss and hasattr(packet, 'flow_id'):
+            for i in xrange(packet.count):
+                self.tracer.emit(
+                    'packet_loss', self.env.now, self.link_name,
+                    self.names[packet.flow_id], packet.packet_no + i)
+        packet.release()
+
+    def feed(self, packet):
+        size = packet.size
+        background = self._background
+        i = self._index
+        held = background.paused
+        if held:
+            if self.buffer_level + size > self.buf_size:
+                self._drop(packet)
+                return
+            self._held += size
+            if self._trace_buf:
+                self.tracer.emit(
+                    'buffer_diff', self.env.now, self.link_name, size)
+        else:
+            background.fed[i] += size
+
+        loss_ratio = background.loss_ratio[i]
+        if loss_ratio:
+            self._drop_credit += loss_ratio * size
+            if self._drop_credit >= size:
+                self._drop_credit -= size
+                self._drop(packet)
+                return
+
+        now = self.env.now
+        rate = self.rate * 1.0E6 / 8
+        departure = max(now + background.level[i] / rate,
+                        self._last_departure) + size / rate
+        self._last_departure = departure
+
+        queue = self._packet_queue
+        queue.append((departure, packet, held))
+        if len(queue) == 1:
+            timer = self.env.timeout(departure - now)
+            timer.callbacks.append(self._depart)
+
+    def _depart(self, event):
+        """Passes on the packets whose transmission has completed."""
+        queue = self._packet_queue
+        now = self.env.now
+
+        # The timer was armed for the head of the queue
+        _, packet, held = queue.popleft()
+        self._pass_on(packet, held)
+
+        while queue and queue[0][0] <= now:
+            _, packet, held = queue.popleft()
+            self._pass_on(packet, held)
+
+        if queue:
+            timer = self.env.timeout(max(0, queue[0][0] - now))
+            timer.callbacks.append(self._depart)
+
+    def _pass_on(self, packet, held):
+        if held:
+            self._held -= packet.size
+            if self._trace_buf:
+                self.tracer.emit(
+                    'buffer_diff', self.env.now, self.link_name,
+                    -1 * packet.size)
+        if packet.count > 1:
+            packet.gap = max(
+                packet.gap, packet._size * 8 / (self.rate * 1.0E6))
+        if self._trace_tx:
+            self.tracer.emit(
+                'transmission', self.env.now, self.link_name, packet.size)
+        self._send_on(packet)
+
+class FluidBackground(object):
+    """Background flows of a Network, simulated as a fluid model.
+
+    The windows of the background flows follow a FlowModel along the
+    shortest paths of Network.routes_to(). Every cable they cross is
+    replaced by a SharedCable, whose fluid queue is fed by their traffic
+    and by the packets of the other flows. Every <dt> seconds, the queues
+    and the windows are moved one step forward, so the cost of the
+    background flows grows with the number of cables they cross rather
+    than with the number of packets they would send. Steps are paused
+    while no background flow is sending and the fluid queues are empty,
+    until the next background flow starts.
+
+    Background traffic is traced as transmissions and buffer changes of
+    the cables, and as data sent, window sizes and round trip times of
+    the flows, once per step. Its losses are not traced.
+
+    Attributes:
+        env: Environment of the Network.
+        dt: Time step in seconds.
+        flows: FlowModel of the background flows.
+        cables: SharedCable objects, one per row of the routing matrices
+            of <flows>.
+        level: Bytes in the buffer of each cable.
+        loss_ratio: Fraction of the traffic each cable dropped during the
+            last step.
+        fed: Bytes of the packets fed to each cable since the last step.
+        paused: Whether steps are paused.
+    """
+
+    def __init__(self, sim, flow_specs, algorithm, dt=1.0E-3):
+        """
+        Args:
+            sim: Network simulating the whole network file.
+            flow_specs: Entries of Network._flow_specs of the background
+                flows.
+            algorithm: Flow class whose fluid model the flows follow.
+            dt: Time step in seconds.
+        """
+        self.env = sim.env
+        self.dt = dt
+        self.tracer = sim.tracer
+        names = sim.names
+        self._names = [names[spec[0]] for spec in flow_specs]
+
+        cables, ends = index_cables(sim)
+        R, A = route_matrices(sim, flow_specs, cables, ends)
+        used = np.flatnonzero((R + A).any(axis=1))
+        by_index = dict((i, key) for key, i in cables.items())
+
+        self.level = np.zeros(len(used))
+        self.loss_ratio = np.zeros(len(used))
+        self.fed = np.zeros(len(used))
+        self.cables = []
+        delay = np.zeros(len(used))
+        self._rate = np.zeros(len(used))
+        self._buf_size = np.zeros(len(used))
+        for j, i in enumerate(used):
+            link_id, src_id = by_index[i]
+            link = sim._nodes[link_id]
+            cable = link._cables[src_id] = \
+                SharedCable(link, src_id, self, j)
+            self.cables.append(cable)
+            delay[j] = cable.delay / 1.0E3
+            self._rate[j] = cable.rate * 1.0E6 / 8
+            self._buf_size[j] = cable.buf_size
+        self.flows = FlowModel(
+            algorithm, flow_specs, R[used], A[used], delay, self._rate, dt)
+        self.paused = False
+
+        # Traced entities as (index, name, ...) tuples
+        tracer = self.tracer
+        self._trace_send = [
+            (i, names[spec[0]], names[spec[1]])
+            for i, spec in enumerate(flow_specs)
+            if tracer.enabled('send_data', names[spec[0]], names[spec[1]])]
+        self._trace_cwnd = [
+            (i, names[spec[0]]) for i, spec in enumerate(flow_specs)
+            if tracer.enabled('window_size', names[spec[0]])]
+        self._trace_rtt = [
+            (i, names[spec[0]]) for i, spec in enumerate(flow_specs)
+            if tracer.enabled('packet_rtt', names[spec[0]])]
+        # Bytes traced so far, since traces have whole bytes
+        self._trace_buf = [
+            (j, c.link_name) for j, c in enumerate(self.cables)
+            if c._trace_buf]
+        self._trace_tx = [
+            (j, c.link_name) for j, c in enumerate(self.cables)
+            if c._trace_tx]
+        self._traced_sent = np.zeros(len(flow_specs))
+        self._traced_level = np.zeros(len(used))
+        self._untraced_tx = np.zeros(len(used))
+
+        self._schedule()
+
+    def completion_times(self):
+        """Dictionary mapping the names of the background flows to the
+        time the ACK of their last packet returned, or None if it has
+        not returned yet."""
+        now = self.env.now
+        return dict(
+            (name, float(t) if t <= now else None)
+            for name, t in zip(self._names, self.flows.finish_time))
+
+    def finished(self):
+        """Whether the ACKs of the last packets of all background flows
+        have returned."""
+        finish_time = self.flows.finish_time
+        return not np.isnan(finish_time).any() and \
+            (finish_time <= self.env.now).all()
+
+    def _step(self, event):
+        """Moves the queues and the background flows one step forward."""
+        dt = self.dt
+        now = self.env.now
+        flows = self.flows
+        self.paused = False
+        rate = self._rate
+        buf_size = self._buf_size
+
+        level = self.level.copy()
+        fed = self.fed.copy()
+
+        active, x, rtt = flows.rates(now, level / rate)
+        background = flows.load(x) * dt
+        arrived = background + fed
+        new_level = level + arrived - rate * dt
+        dropped = np.maximum(new_level - buf_size, 0.0)
+        new_level = np.clip(new_level, 0.0, buf_size)
+        drop_ratio = dropped / np.maximum(arrived, 1.0E-12)
+        flows.advance(now, active, x, rtt, drop_ratio)
+
+        self.fed[:] = 0
+        self.level[:] = new_level
+        self.loss_ratio[:] = drop_ratio
+        self._trace(now, x, rtt, active, new_level,
+                    (level + arrived - dropped - new_level) *
+                    background / np.maximum(arrived, 1.0E-12))
+        self._schedule()
+
+    def _schedule(self):
+        """Arms the timer of the next step, which waits for the next start
+        of a background flow if none is sending and the queues are
+        empty."""
+        now = self.env.now
+        flows = self.flows
+        if flows.sending(now).any() or self.level.any():
+            timer = self.env.timeout(self.dt)
+            timer.callbacks.append(self._step)
+            return
+
+        self.paused = True
+        self.loss_ratio[:] = 0.0
+        delay = flows.next_start(now) - now
+        if not np.isinf(delay):
+            timer = self.env.timeout(delay)
+            timer.callbacks.append(self._step)
+
+    def _trace(self, now, x, rtt, active, level, background_tx):
+        """Emits the traced events of a step, rounded to whole bytes."""
+        emit = self.tracer.emit
+        for i, name in self._trace_buf:
+            diff = int(round(level[i] - self._traced_level[i]))
+            if diff:
+                self._traced_level[i] += diff
+                emit('buffer_diff', now, name, diff)
+        for i, name in self._trace_tx:
+            self._untraced_tx[i] += background_tx[i]
+            size = int(self._untraced_tx[i])
+            if size:
+                self._untraced_tx[i] -= size
+                emit('transmission', now, name, size)
+
+        sent = self.flows.sent
+        for i, name, host in self._trace_send:
+            size = int(sent[i] * DataPacket._size - self._traced_sent[i])
+            if size:
+                self._traced_sent[i] += size
+                emit('send_data', now, name, host, size, int(sent[i]))
+        for i, name in self._trace_cwnd:
+            if active[i]:
+                emit('window_size', now, name, self.flows.window[i])
+        for i, name in self._trace_rtt:
+            if active[i]:
+                emit('packet_rtt', now, name, rtt[i])
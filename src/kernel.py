@@ -0,0 +1,343 @@
+from __future__ import division, print_function
+from bisect import insort
+from functools import partial
+from heapq import heappush, heappop, nsmallest
+from itertools import count
+
+try:
+    from simpy.core import StopSimulation
+except ImportError:
+    class StopSimulation(Exception):
+        """Raised by a callback to end Kernel.run() early."""
+
+class Timer(object):
+    """Event of a Kernel that fires after a delay.
+
+    Attributes:
+        callbacks: List of functions called with the timer when it fires,
+            or None once it has fired or has been cancelled.
+    """
+
+    __slots__ = ('callbacks',)
+
+    def __init__(self):
+        self.callbacks = []
+
+    def cancel(self):
+        """Prevents the timer from firing."""
+        self.callbacks = None
+
+class CalendarQueue(object):
+    """Calendar queue priority structure (R. Brown, CACM 31(10), 1988).
+
+    Items are tuples starting with the time, such as (time, eid, payload),
+    and pop() returns them in ascending order, exactly like heappop() on a
+    binary heap. Time is cut into buckets of equal width which wrap around
+    after a "year" of nbuckets buckets, like the days of a desk calendar.
+    Each bucket is a short sorted list, so push() and pop() take amortized
+    O(1) time instead of O(log n) as long as the bucket width matches the
+    spacing of the pending items. The number of buckets doubles or halves
+    as the queue grows and shrinks, and the width is then re-estimated
+    from the items due next.
+    """
+
+    _min_buckets = 16
+    # Number of items due next used to estimate the bucket width
+    _sample_size = 25
+
+    def __init__(self, width=1.0):
+        self._size = 0
+        self._buckets = []
+        self._setup(self._min_buckets, width, 0)
+
+    def __len__(self):
+        return self._size
+
+    def _setup(self, nbuckets, width, bucket):
+        """Empties the calendar and sets its geometry; <bucket> is the
+        virtual bucket, i.e. int(time / width), where pop() starts."""
+        self._nbuckets = nbuckets
+        self._mask = nbuckets - 1
+        self._width = width
+        self._bucket = bucket
+        self._buckets = [[] for _ in range(nbuckets)]
+        self._grow_at = 2 * nbuckets
+        if nbuckets > self._min_buckets:
+            self._shrink_at = nbuckets // 2
+        else:
+            self._shrink_at = -1
+
+    def push(self, item):
+        """Adds an item to the queue."""
+        bucket = int(item[0] / self._width)
+        b = self._buckets[bucket & self._mask]
+        if not b or item > b[-1]:
+            b.append(item)
+        else:
+            insort(b, item)
+        if bucket < self._bucket:
+            self._bucket = bucket
+        self._size += 1
+        if self._size > self._grow_at:
+            self._resize(2 * self._nbuckets)
+
+    def pop(self):
+        """Removes and returns the smallest item."""
+        if not self._size:
+            raise IndexError('pop from empty calendar queue')
+        buckets = self._buckets
+        mask = self._mask
+        width = self._width
+
+        # Look for an item due this year, one bucket after the other
+        for bucket in xrange(self._bucket, self._bucket + self._nbuckets):
+            b = buckets[bucket & mask]
+            if b and int(b[0][0] / width) <= bucket:
+                break
+        else:
+            # Nothing due within a year: jump straight to the first item
+            bucket = int(min(b[0] for b in buckets if b)[0] / width)
+            b = buckets[bucket & mask]
+
+        self._bucket = bucket
+        item = b.pop(0)
+        self._size -= 1
+        if self._size < self._shrink_at:
+            self._resize(self._nbuckets // 2)
+        return item
+
+    def _resize(self, nbuckets):
+        """Moves all items to a calendar of <nbuckets> buckets."""
+        items = [item for b in self._buckets for item in b]
+        sample = nsmallest(self._sample_size, items)
+
+        # Three times the typical spacing of the items due next, ignoring
+        # large gaps, following Brown
+        width = self._width
+        gaps = [b[0] - a[0] for a, b in zip(sample, sample[1:])]
+        if gaps:
+            mean = sum(gaps) / len(gaps)
+            gaps = [g for g in gaps if g <= 2 * mean]
+            if gaps and sum(gaps) > 0:
+                width = 3 * sum(gaps) / len(gaps)
+
+        self._setup(nbuckets, width, int(sample[0][0] / width))
+        size = self._size
+        self._size = 0
+        for item in items:
+            self.push(item)
+        assert self._size == size
+
+class Lineage(object):
+    """Place of a timer among the timers due at the same time, comparable
+    across processes.
+
+    A Kernel fires the timers due at the same time in the order they were
+    created, that is in the order of the timers whose callbacks made them,
+    and then in the order each callback made them. A lineage records this
+    as the chain of timers leading to a timer, so that the processes of a
+    parallel run, which each create only some of the timers, order them
+    as a serial run would. Chains are cut back to <depth> timers once they
+    get twice as long, and timers whose chains do not meet within that
+    are ordered arbitrarily.
+
+    Attributes:
+        at: Time the timer fires.
+        created: Time the timer was created.
+        parent: Lineage of the timer whose callbacks made this one, or None
+            if it was made before the simulation started or the chain was
+            cut there.
+        index: Number of timers made before it by the same callbacks, or
+            before the simulation started.
+        ident: (process, timer number) pair identifying the timer.
+        root: Whether the timer was made before the simulation started.
+        length: Number of timers in the chain.
+    """
+
+    __slots__ = ('at', 'created', 'parent', 'index', 'ident', 'root', 'length')
+
+    # Number of timers a chain keeps at least
+    depth = 8
+
+    def __init__(self, at, created, parent, index, ident, root=None):
+        self.at = at
+        self.created = created
+        self.parent = parent
+        self.index = index
+        self.ident = ident
+        self.root = parent is None if root is None else root
+        self.length = parent.length + 1 if parent is not None else 1
+
+    def __reduce__(self):
+        # Much faster to pickle than the state of an object with slots
+        return Lineage, (
+            self.at, self.created, self.parent, self.index, self.ident,
+            self.root)
+
+    def __lt__(self, other):
+        """Whether this timer fires before <other>, which is due at the same
+        time and was created at the same time."""
+        a, b = self, other
+        while a.parent is not None and b.parent is not None:
+            pa, pb = a.parent, b.parent
+            if pa.ident == pb.ident:
+                return a.index < b.index
+            if pa.at != pb.at or pa.created != pb.created:
+                return (pa.at, pa.created) < (pb.at, pb.created)
+            a, b = pa, pb
+        if a.root or b.root:
+            if a.root and b.root:
+                return a.index < b.index
+            return a.root
+        return a.ident < b.ident
+
+    def __gt__(self, other):
+        return other.__lt__(self)
+
+    def cut(self):
+        """Returns this lineage with its chain cut back to <depth> timers."""
+        chain = []
+        lineage = self
+        while len(chain) < self.depth:
+            chain.append(lineage)
+            lineage = lineage.parent
+        parent = None
+        for lineage in reversed(chain):
+            parent = Lineage(
+                lineage.at, lineage.created, parent, lineage.index,
+                lineage.ident, lineage.root)
+        return parent
+
+class Kernel(object):
+    """Lightweight event scheduler to run the simulation without SimPy.
+
+    It provides the part of the simpy.Environment interface the simulator
+    uses: now, timeout() returning an event with a list of callbacks, and
+    run(). Timers are kept in a binary heap, or in a CalendarQueue if
+    <event_list> is 'calendar', which pays off for very large numbers of
+    pending timers. Timers due at the same time fire in the order they
+    were created, just like SimPy timeouts, so a simulation produces the
+    same trace on either scheduler and event list. Ties are actually
+    broken by creation time first, which only makes a difference for
+    timers made by schedule().
+
+    Given a <lineage> name, a Kernel orders timers due at the same time by
+    their Lineage instead of their creation, which gives the same order
+    but can also place timers made by other processes.
+
+    Attributes:
+        now: Current simulation time in seconds.
+        event_list: 'heap' or 'calendar'.
+        lineage: Name of this kernel among the processes of a parallel
+            run, or None to order timers by creation.
+        firing: (creation time, Lineage) of the timer whose callbacks are
+            running, if ordered by lineage, or None.
+    """
+
+    def __init__(self, initial_time=0, event_list='heap', lineage=None):
+        self.now = initial_time
+        self.event_list = event_list
+        self.lineage = lineage
+        self.firing = None
+        # Number of timers made by the callbacks running, or before the
+        # simulation started
+        self._made = 0
+        if event_list == 'heap':
+            self._queue = []
+            self._push = partial(heappush, self._queue)
+            self._pop = partial(heappop, self._queue)
+        elif event_list == 'calendar':
+            self._queue = CalendarQueue()
+            self._push = self._queue.push
+            self._pop = self._queue.pop
+        else:
+            raise ValueError('Unknown event list {}'.format(event_list))
+        self._eid = count()
+
+    def timeout(self, delay):
+        """Returns a Timer firing <delay> seconds from now."""
+        if delay < 0:
+            raise ValueError('Negative delay {}'.format(delay))
+        timer = Timer()
+        if self.lineage is None:
+            self._push((self.now + delay, self.now, next(self._eid), timer))
+        else:
+            self._push((
+                self.now + delay, self.now, self.reserve(self.now + delay),
+                timer))
+        return timer
+
+    def reserve(self, at):
+        """Returns the Lineage of a timer firing at time <at> made now, for
+        another process to schedule(), and counts it as made here."""
+        parent = self.firing[1] if self.firing is not None else None
+        lineage = Lineage(
+            at, self.now, parent, self._made,
+            (self.lineage, next(self._eid)))
+        self._made += 1
+        return lineage
+
+    def schedule(self, at, created, lineage=None):
+        """Returns a Timer firing at time <at>, ordered among the timers due
+        at the same time as if it had been created at time <created>, and
+        by <lineage> if the kernel orders timers by lineage.
+
+        This lets parallel.py deliver a packet from another process in the
+        order a serial run would have delivered it.
+        """
+        if at < self.now:
+            raise ValueError('Time {} is in the past'.format(at))
+        timer = Timer()
+        if self.lineage is None:
+            self._push((at, created, next(self._eid), timer))
+        else:
+            self._push((at, created, lineage, timer))
+        return timer
+
+    def run(self, until=None):
+        """Fires timers until time <until> or until none are left.
+
+        Like with SimPy, timers due exactly at <until> do not fire before
+        run() returns, and a callback can end run() at once by raising
+        StopSimulation.
+        """
+        queue = self._queue
+        pop = self._pop
+        by_lineage = self.lineage is not None
+        cut_at = 2 * Lineage.depth
+
+        if until is None:
+            stop = float('inf')
+        else:
+            at = float(until)
+            if at <= self.now:
+                raise ValueError(
+                    'until(={}) should be > the current simulation '
+                    'time.'.format(at))
+            # Same rounding as SimPy, which schedules a stop event
+            stop = self.now + (at - self.now)
+
+        try:
+            while queue:
+                item = pop()
+                if item[0] >= stop:
+                    self._push(item)
+                    break
+                self.now, created, key, timer = item
+                callbacks = timer.callbacks
+                if callbacks is not None:
+                    timer.callbacks = None
+                    if by_lineage:
+                        if key.length >= cut_at:
+                            key = key.cut()
+                        self.firing = created, key
+                        self._made = 0
+                    for callback in callbacks:
+                        callback(timer)
+        except StopSimulation:
+            return
+        finally:
+            self.firing = None
+
+        if until is not None:
+            self.now = stop
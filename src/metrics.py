@@ -0,0 +1,178 @@
+from __future__ import division, print_function
+from collections import defaultdict
+import sys
+
+from tracer import Tracer
+
+class MetricBin(object):
+    """Per interval aggregates of one time bin.
+
+    Attributes:
+        key: Bin number, i.e. the bin covers [key / freq, (key + 1) / freq).
+    """
+
+    __slots__ = [
+        'key', 'link_flow_sum', 'host_send_sum', 'flow_send_sum',
+        'packet_loss_sum', 'packet_rtt_sum', 'packet_rtt_count',
+        'window_size_sum', 'window_size_count', 'buffer_level_sum',
+        'buffer_level_count']
+
+    def __init__(self, key):
+        self.key = key
+        self.link_flow_sum = defaultdict(int)
+        self.host_send_sum = defaultdict(int)
+        self.flow_send_sum = defaultdict(int)
+        self.packet_loss_sum = defaultdict(int)
+        self.packet_rtt_sum = defaultdict(float)
+        self.packet_rtt_count = defaultdict(int)
+        self.window_size_sum = defaultdict(int)
+        self.window_size_count = defaultdict(int)
+        self.buffer_level_sum = defaultdict(int)
+        self.buffer_level_count = defaultdict(int)
+
+    def merge(self, other):
+        """Adds the aggregates of <other>, a bin of the same interval
+        collected from another part of the network.
+
+        The buffer level of a link only adds up if all its events were
+        collected by one of the two.
+        """
+        for name in (
+            'link_flow_sum', 'host_send_sum', 'flow_send_sum',
+            'packet_loss_sum', 'packet_rtt_sum', 'packet_rtt_count',
+            'window_size_sum', 'window_size_count', 'buffer_level_sum',
+            'buffer_level_count'):
+            sums = getattr(self, name)
+            for k, v in getattr(other, name).items():
+                sums[k] += v
+
+class MetricCollector(Tracer):
+    """Aggregates the selected metrics during the simulation.
+
+    This tracer keeps the same per interval sums as process.py and writes
+    the binned series when closed, so that no event log is needed. The
+    output is identical to running process.py on the text log of the same
+    simulation. The output selection is read from the header comments just
+    like process.py does.
+
+    Attributes:
+        stream: File object the binned series is written to.
+        freq: Number of bins per second.
+        output_sel: Dictionary mapping metric names to selected IDs.
+        bins: List of MetricBin objects in time order.
+    """
+
+    def __init__(self, stream=None, freq=5):
+        self.stream = stream if stream is not None else sys.stdout
+        self.freq = freq
+        self.output_sel = defaultdict(frozenset)
+        self.bins = []
+
+        # Buffer occupancy per link over the whole run
+        self._buffer_level = defaultdict(int)
+
+        self._last_now = None
+        self._bin = None
+
+    def comment(self, text=''):
+        fields = text.split()
+        if fields:
+            self.output_sel[fields[0]] = frozenset(fields[1:])
+
+    def _current_bin(self, now):
+        """Returns the bin of an event at time <now>."""
+        if now != self._last_now:
+            self._last_now = now
+            # Bin by the logged time, which is rounded to microseconds
+            key = int(self.freq * float('{:.6f}'.format(now)))
+            if self._bin is None or key != self._bin.key:
+                self._bin = MetricBin(key)
+                self.bins.append(self._bin)
+        return self._bin
+
+    def emit(self, kind, now, *args):
+        b = self._current_bin(now)
+
+        if kind == 'send_data':
+            b.flow_send_sum[args[0]] += args[2]
+            b.host_send_sum[args[1]] += args[2]
+        elif kind == 'packet_loss':
+            b.packet_loss_sum[args[0]] += 1
+        elif kind == 'packet_rtt':
+            # Sum the delay as it appears in the text log
+            b.packet_rtt_sum[args[0]] += float('{}'.format(args[1]))
+            b.packet_rtt_count[args[0]] += 1
+        elif kind == 'transmission':
+            b.link_flow_sum[args[0]] += args[1]
+        elif kind == 'buffer_diff':
+            link_id = args[0]
+            self._buffer_level[link_id] += args[1]
+            b.buffer_level_sum[link_id] += self._buffer_level[link_id]
+            b.buffer_level_count[link_id] += 1
+        elif kind == 'window_size':
+            b.window_size_sum[args[0]] += int(float('{:.3f}'.format(args[1])))
+            b.window_size_count[args[0]] += 1
+
+    def merge(self, bins):
+        """Adds the bins collected by another MetricCollector from a
+        simulation of another part of the same network."""
+        by_key = dict((b.key, b) for b in self.bins)
+        for b in bins:
+            if b.key in by_key:
+                by_key[b.key].merge(b)
+            else:
+                by_key[b.key] = b
+        self.bins = [by_key[key] for key in sorted(by_key)]
+        self._last_now = None
+        self._bin = None
+
+    def write(self, stream=None):
+        """Writes the binned series in the output format of process.py."""
+        if stream is None:
+            stream = self.stream
+        freq = self.freq
+        output_sel = self.output_sel
+
+        for b in self.bins:
+            t = b.key / freq
+            lines = []
+
+            for name in output_sel['flow_send_rate']:
+                lines.append('{} flow_send_rate {} {}'.format(t, name,
+                    b.flow_send_sum[name] * 8 / 1.0E6 * freq))
+
+            for name in output_sel['host_send_rate']:
+                lines.append('{} host_send_rate {} {}'.format(t, name,
+                    b.host_send_sum[name] * 8 / 1.0E6 * freq))
+
+            for name in output_sel['packet_loss_rate']:
+                lines.append('{} packet_loss_rate {} {}'.format(t, name,
+                    b.packet_loss_sum[name] * freq))
+
+            for name in output_sel['packet_rtt']:
+                if b.packet_rtt_count[name]:
+                    lines.append('{} packet_rtt {} {}'.format(t, name,
+                        b.packet_rtt_sum[name] / b.packet_rtt_count[name]))
+
+            for name in output_sel['link_flow_rate']:
+                lines.append('{} link_flow_rate {} {}'.format(t, name,
+                    b.link_flow_sum[name] * 8 / 1.0E6 * freq))
+
+            for name in output_sel['buf_level']:
+                if b.buffer_level_count[name]:
+                    lines.append('{} buf_level {} {}'.format(t, name,
+                        b.buffer_level_sum[name] / 1000 /
+                        b.buffer_level_count[name]))
+
+            for name in output_sel['window_size']:
+                if b.window_size_count[name]:
+                    lines.append('{} window_size {} {}'.format(t, name,
+                        b.window_size_sum[name] / b.window_size_count[name]))
+
+            for line in lines:
+                stream.write(line + '\n')
+
+        stream.flush()
+
+    def close(self):
+        self.write()
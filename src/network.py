@@ -1,11 +1,25 @@
 #!/usr/bin/env python
 from __future__ import division, print_function
+import argparse
+import heapq
 import simpy
 import os
 import sys
 from device import Host, Link, Router
+from kernel import Kernel, StopSimulation
 from packet import DataPacket
 from flow import TCPTahoeFlow, TCPRenoFlow, FastTCPFlow, CubicTCPFlow
+from tracer import TextTracer, BinaryTracer
+from metrics import MetricCollector
+from steady import SteadyStateMonitor, parse_batch, parse_batches
+
+# Flow classes by the algorithm names accepted on the command line
+alg_dict = {
+    'tahoe': TCPTahoeFlow,
+    'reno': TCPRenoFlow,
+    'fast': FastTCPFlow,
+    'cubic': CubicTCPFlow
+}
 
 class Network(object):
 
@@ -16,27 +30,127 @@ class Network(object):
         routers: List of all Router objects in the network.
         links: List of all Link objects in the network.
         flows: List of all Flow objects in the network.
+        tracer: Tracer object shared by all devices and flows.
+        names: List mapping the integer IDs of hosts, routers, links and
+            flows to their names in the network file. Hosts come first so
+            that routers can index their tables by host ID.
+        output_sel: Dictionary mapping metric names to the selected entity
+            IDs from the last section of the network file.
+        routing: 'dynamic' to discover routes with SonarPacket/EchoPacket
+            during the simulation, or 'static' to install shortest-path
+            forwarding tables before it starts.
+        train_size: Maximum number of packets a flow sends as one packet
+            train, or 1 to simulate every packet on its own. FAST flows
+            always send packets on their own.
+        scheduler: 'simpy' to run on simpy.Environment, 'kernel' to run
+            on the lighter Kernel, or 'calendar' to run on a Kernel with a
+            calendar queue as event list, unless an environment is given.
+        local: Set of names of the hosts and routers simulated by this
+            Network, or None if it simulates all of them.
+        link_params: Dictionary mapping link names, or '*' for all links,
+            to dictionaries of values replacing the rate, delay or
+            buf_size given in the network file.
+        background: 'fluid' to model the flows marked as background in
+            the network file with a FluidBackground, or 'packet' to
+            simulate them like the other flows.
+        fluid: FluidBackground of the background flows, or None.
+        _ids: Dictionary mapping names in the network file to IDs.
+        _n_hosts: Number of hosts in the network file.
+        _node_ids: IDs of all hosts and routers in the network file.
+        _link_specs: (link ID, end ID, end ID, rate, delay, buf_size)
+            tuples of all links in the network file, simulated or not.
+        _flow_specs: (flow ID, source ID, destination ID, data_mb,
+            start_s, background) tuples of all flows in the network file.
         _nodes: Contains additional information about each Host/Router.
         _edges: Contains additional information about each Link.
     """
 
-    def __init__(self, env, filename, algorithm=FastTCPFlow, alg_args=None):
-        """Constructor for the Network object"""
+    # Link parameters in the order of the network file
+    _link_fields = ('rate', 'delay', 'buf_size')
+
+    def __init__(
+        self, env, filename, algorithm=FastTCPFlow, alg_args=None,
+        tracer=None, full_trace=False, routing='dynamic', train_size=1,
+        scheduler='simpy', local=None, link_params=None,
+        background='fluid'):
+        """Constructor for the Network object
+
+        Unless <full_trace> is set, only the events needed for the output
+        selection of the network file are traced. With <train_size> > 1,
+        bursts of new packets are simulated as packet trains, which is
+        much faster for bulk transfers but less exact.
+
+        If <local> is given, only that part of the network is simulated:
+        the hosts and routers named in it, the links attached to them and
+        the flows starting from them. Links leading out of the part have
+        a single port. This is how parallel.py splits a simulation across
+        processes.
+
+        <link_params> overrides link parameters of the network file, e.g.
+        {'*': {'buf_size': 32}, 'L1': {'rate': 5}} to shrink all buffers
+        to 32 KB and slow down L1 to 5 Mbps. Parameters of a named link
+        take precedence over those for '*'.
+
+        Flows whose line in the network file ends with 'background', e.g.
+        'F4 S1 T1 20 0 background', only load the links for the flows
+        under study. With <background> = 'fluid', they are not simulated
+        packet by packet but as a fluid model that shares the buffers and
+        capacity of the links with the packets of the other flows, see
+        hybrid.py. This needs NumPy and the whole network.
+        """
+        if routing not in ('dynamic', 'static'):
+            raise ValueError('Unknown routing mode {}'.format(routing))
+        if scheduler not in ('simpy', 'kernel', 'calendar'):
+            raise ValueError('Unknown scheduler {}'.format(scheduler))
+        if background not in ('fluid', 'packet'):
+            raise ValueError(
+                'Unknown background mode {}'.format(background))
         super(Network, self).__init__()
 
         self.algorithm = algorithm
 
+        if tracer is None:
+            tracer = TextTracer()
+        self.tracer = tracer
+
         self.hosts = []
         self.routers = []
         self.links = []
         self.flows = []
+        self.output_sel = {}
+        self.names = []
+        self.full_trace = full_trace
+        self.routing = routing
+        self.train_size = train_size
+        self.background = background
+        self.fluid = None
+        # Flows left to finish before stopping, if stop_when_finished(),
+        # and how often to check the links are drained after that
+        self._unfinished = None
+        self._drain_interval = None
+        self.local = frozenset(local) if local is not None else None
+        self.link_params = link_params or {}
+        for params in self.link_params.values():
+            for param in params:
+                if param not in self._link_fields:
+                    raise ValueError('Unknown link parameter {}'.format(param))
 
+        self._ids = {}
+        self._n_hosts = 0
+        self._node_ids = []
+        self._link_specs = []
+        self._flow_specs = []
         self._nodes = {}
         self._edges = []
 
         # Initiates new environment to simulate network
         if env is None:
-            env = simpy.Environment()
+            if scheduler == 'kernel':
+                env = Kernel()
+            elif scheduler == 'calendar':
+                env = Kernel(event_list='calendar')
+            else:
+                env = simpy.Environment()
         self.env = env
         
         self.parse_network(filename)
@@ -47,6 +161,7 @@ class Network(object):
             stream = open(filename, 'r')
         else:
             stream = sys.stdin
+        sections = [[] for _ in range(5)]
         sect_idx = 0
         for line in stream:
             fields = line.strip().split()
@@ -54,32 +169,90 @@ class Network(object):
                 continue
             if line[0] == '-':
                 sect_idx += 1
-            elif sect_idx == 0:
-                h = Host(self.env, fields[0])
-                self.hosts.append(h)
-                self._nodes[fields[0]] = h
-            elif sect_idx == 1:
-                r = Router(self.env, fields[0])
-                self.routers.append(r)
-                self._nodes[fields[0]] = r
-            elif sect_idx == 2:
-                fields[3:6] = map(float, fields[3:6])
-                l = Link(self.env, fields[0], fields[3], fields[4], fields[5])
-                self.links.append(l)
-                self._nodes[fields[0]] = l
-                self._edges.append((fields[0], fields[1]))
-                self._edges.append((fields[0], fields[2]))
-            elif sect_idx == 3:
-                fields[3:4] = map(float, fields[3:5])
-                f = self.algorithm(
-                    self.env, 
-                    fields[0], fields[1], fields[2], fields[3], fields[4])
-                self.flows.append(f)
-            elif sect_idx == 4:
-                print('# ' + line.strip())
-        print('#')
+            elif sect_idx < len(sections):
+                sections[sect_idx].append((line.strip(), fields))
         stream.close()
 
+        # Output selection comes first so that devices and flows know which
+        # events to trace when they are created
+        for line, fields in sections[4]:
+            self.output_sel[fields[0]] = frozenset(fields[1:])
+            self.tracer.comment(line)
+        self.tracer.comment()
+        if sections[4] and not self.full_trace:
+            self.tracer.select(self.output_sel)
+
+        # Intern names into dense integer IDs in file order, hosts first
+        for section in sections[:4]:
+            for line, fields in section:
+                self._ids[fields[0]] = len(self.names)
+                self.names.append(fields[0])
+        ids = self._ids
+        self._n_hosts = len(sections[0])
+        self._node_ids = [ids[fields[0]] for _, fields in sections[0]] + \
+            [ids[fields[0]] for _, fields in sections[1]]
+
+        for sect_idx, section in enumerate(sections[:4]):
+            for line, fields in section:
+                if sect_idx == 2:
+                    fields[3:6] = map(float, fields[3:6])
+                    for key in ('*', fields[0]):
+                        for param, value in \
+                            self.link_params.get(key, {}).items():
+                            fields[3 + self._link_fields.index(param)] = \
+                                float(value)
+                    self._link_specs.append((
+                        ids[fields[0]], ids[fields[1]], ids[fields[2]],
+                        fields[3], fields[4], fields[5]))
+                elif sect_idx == 3:
+                    fields[3:5] = map(float, fields[3:5])
+                    if fields[5:] not in ([], ['background']):
+                        raise ValueError(
+                            'Unknown flow option {}'.format(fields[5]))
+                    self._flow_specs.append((
+                        ids[fields[0]], ids[fields[1]], ids[fields[2]],
+                        fields[3], fields[4], len(fields) > 5))
+                    if len(fields) > 5 and self.background == 'fluid':
+                        continue
+                if not self._simulates(sect_idx, fields):
+                    if sect_idx == 3 or \
+                        sect_idx == 0 and self.routing == 'dynamic':
+                        # Stands in for the first timer of the host or flow
+                        # simulated elsewhere, so that timers are numbered
+                        # as in a serial run
+                        self.env.timeout(0)
+                    continue
+                if sect_idx == 0:
+                    h = Host(
+                        self.env, ids[fields[0]], self.tracer,
+                        dynamic_routing=(self.routing == 'dynamic'),
+                        names=self.names)
+                    self.hosts.append(h)
+                    self._nodes[h.dev_id] = h
+                elif sect_idx == 1:
+                    r = Router(
+                        self.env, ids[fields[0]], self.tracer,
+                        n_hosts=len(sections[0]), names=self.names)
+                    self.routers.append(r)
+                    self._nodes[r.dev_id] = r
+                elif sect_idx == 2:
+                    l = Link(
+                        self.env, ids[fields[0]],
+                        fields[3], fields[4], fields[5],
+                        self.tracer, names=self.names)
+                    self.links.append(l)
+                    self._nodes[l.dev_id] = l
+                    for end in fields[1:3]:
+                        if self.local is None or end in self.local:
+                            self._edges.append((l.dev_id, ids[end]))
+                elif sect_idx == 3:
+                    f = self.algorithm(
+                        self.env, ids[fields[0]],
+                        ids[fields[1]], ids[fields[2]], fields[3], fields[4],
+                        self.tracer, names=self.names)
+                    f.train_size = self.train_size
+                    self.flows.append(f)
+
         # Establish communication between devices
         for e in self._edges:
             n = (self._nodes[e[0]], self._nodes[e[1]])
@@ -90,38 +263,273 @@ class Network(object):
         for f in self.flows:
             self._nodes[f.src].add_flow(f)
 
-    def run(self, until=None):
-        """Initiates run of simulation environment."""
-        return self.env.run(until=until)
+        if self.routing == 'static':
+            self.install_static_routes()
+
+        background = [spec for spec in self._flow_specs if spec[5]]
+        if background and self.background == 'fluid':
+            if self.local is None:
+                # NumPy is only needed for hybrid simulations
+                from hybrid import FluidBackground
+                self.fluid = FluidBackground(
+                    self, background, self.algorithm)
+            elif self.local:
+                raise ValueError(
+                    'Fluid background flows need the whole network')
+
+    def _simulates(self, sect_idx, fields):
+        """Whether the entry <fields> of network file section <sect_idx>
+        belongs to the simulated part of the network."""
+        local = self.local
+        if local is None:
+            return True
+        if sect_idx < 2:
+            # Hosts and routers
+            return fields[0] in local
+        if sect_idx == 2:
+            # Links attached to a simulated host or router
+            return fields[1] in local or fields[2] in local
+        # Flows starting from a simulated host
+        return fields[1] in local
+
+    def link_cost(self, rate, delay):
+        """Routing cost of a link of <rate> Mbps and <delay> ms: propagation
+        delay plus the transmission time of a data packet, in seconds."""
+        return delay / 1.0E3 + DataPacket._size * 8 / (rate * 1.0E6)
+
+    def routes_to(self, h):
+        """Shortest paths towards host <h> over the whole topology of the
+        network file.
+
+        Runs Dijkstra's algorithm from <h>, weighting links by link_cost().
+        Ties are broken by the order in which links appear in the network
+        file.
+
+        Returns:
+            Dictionary mapping the ID of every device that can reach <h>
+            to the ID of the link through which it sends packets to <h>.
+        """
+        adjacent = dict((dev_id, []) for dev_id in self._node_ids)
+        for link_id, a, b, rate, delay, _ in self._link_specs:
+            cost = self.link_cost(rate, delay)
+            adjacent[a].append((cost, link_id, b))
+            adjacent[b].append((cost, link_id, a))
+
+        dist = {h: 0.0}
+        port = {}
+        done = set()
+        heap = [(0.0, 0, h)]
+        count = 1
+        while heap:
+            d, _, x = heapq.heappop(heap)
+            if x in done:
+                continue
+            done.add(x)
+            if x != h and x < self._n_hosts:
+                # Hosts do not forward packets
+                continue
+            for cost, link_id, y in adjacent[x]:
+                if y not in dist or d + cost < dist[y]:
+                    dist[y] = d + cost
+                    port[y] = link_id
+                    heapq.heappush(heap, (d + cost, count, y))
+                    count += 1
+        return port
+
+    def install_static_routes(self):
+        """Fills the forwarding tables of all routers with the shortest
+        paths of routes_to()."""
+        for h in self._node_ids[:self._n_hosts]:
+            port = self.routes_to(h)
+            for r in self.routers:
+                if r.dev_id in port:
+                    r.set_forward(h, port[r.dev_id])
+
+    def switch_algorithm(self, algorithm):
+        """Continues all flows with another congestion control algorithm.
+
+        Args:
+            algorithm: Flow class such as TCPRenoFlow.
+        """
+        self.algorithm = algorithm
+        for f in self.flows:
+            f.switch_algorithm(algorithm)
+
+    def configure_links(self, link_params):
+        """Changes link parameters during the simulation.
+
+        Args:
+            link_params: Dictionary in the format of the <link_params>
+                argument of the constructor. Only the rate and buf_size
+                can be changed.
+        """
+        for params in link_params.values():
+            for param in params:
+                if param not in ('rate', 'buf_size'):
+                    raise ValueError(
+                        'Cannot change link parameter {}'.format(param))
+        for l in self.links:
+            params = dict(link_params.get('*', {}))
+            params.update(link_params.get(l.name, {}))
+            if params:
+                l.configure(**params)
+
+    def stop(self):
+        """Ends run() once the events due at the current time have fired.
+
+        Any callback can call this to end the simulation early.
+        """
+        timer = self.env.timeout(0)
+        timer.callbacks.append(self._end_run)
+
+    def _end_run(self, event):
+        raise StopSimulation(None)
+
+    def stop_when(self, condition, interval):
+        """Calls stop() as soon as <condition>() is true, checking every
+        <interval> seconds of simulated time from now on."""
+        def check(event):
+            if condition():
+                self.stop()
+            else:
+                timer = self.env.timeout(interval)
+                timer.callbacks.append(check)
+        timer = self.env.timeout(0)
+        timer.callbacks.append(check)
+
+    def stop_when_finished(self, interval=1.0E-3):
+        """Ends the simulation once all flows have finished and no packets
+        are left in the links.
+
+        Once the last flow has finished, the links are checked every
+        <interval> seconds until they are drained.
+        """
+        if self._unfinished is not None:
+            return
+        self._unfinished = 0
+        self._drain_interval = interval
+        for f in self.flows:
+            if f.finish_time is None:
+                self._unfinished += 1
+                f.finish_callbacks.append(self._flow_finished)
+        if not self._unfinished:
+            self.stop_when(self.drained, interval)
+
+    def _flow_finished(self, flow):
+        self._unfinished -= 1
+        if not self._unfinished:
+            self.stop_when(self.drained, self._drain_interval)
+
+    def drained(self):
+        """Whether all flows have finished and no packets are left in the
+        buffers and delay lines of the links."""
+        if any(f.finish_time is None for f in self.flows):
+            return False
+        if self.fluid is not None and not self.fluid.finished():
+            return False
+        return not any(
+            cable._packet_queue or cable._delay_line
+            for l in self.links for cable in l._cables.values())
+
+    def completion_times(self):
+        """Dictionary mapping the names of all simulated flows to the time
+        they finished in seconds, or None if they have not finished."""
+        times = dict((f.name, f.finish_time) for f in self.flows)
+        if self.fluid is not None:
+            times.update(self.fluid.completion_times())
+        return times
+
+    def run(self, until=None, until_finished=False):
+        """Initiates run of simulation environment.
+
+        With <until_finished>, the simulation ends at time <until> or as
+        soon as stop_when_finished() ends it, whichever comes first.
+        """
+        if until_finished:
+            self.stop_when_finished()
+        try:
+            return self.env.run(until=until)
+        finally:
+            self.tracer.flush()
     
 
-if __name__ == '__main__':
-    alg_dict = {
-        'tahoe': TCPTahoeFlow,
-        'reno': TCPRenoFlow,
-        'fast': FastTCPFlow,
-        'cubic': CubicTCPFlow
+def main(argv=None):
+    trace_dict = {
+        'text': TextTracer,
+        'binary': BinaryTracer,
+        'metrics': MetricCollector
     }
 
-    usage = ''.join([
-        'Usage: ',
-        '{} sim_time [flow_alg=fast]\n'.format(sys.argv[0]),
-        'flow_alg = {}.\n\n'.format(', '.join(alg_dict))])
+    parser = argparse.ArgumentParser(
+        description='Simulate the network read from standard input.')
+    parser.add_argument('sim_time', type=float)
+    parser.add_argument(
+        'flow_alg', nargs='?', default='fast', choices=sorted(alg_dict))
+    parser.add_argument(
+        'trace', nargs='?', default='text', choices=sorted(trace_dict))
+    parser.add_argument(
+        'freq', nargs='?', default=5, type=int,
+        help='bins per second for trace = metrics')
+    parser.add_argument(
+        '--routing', default='dynamic', choices=['dynamic', 'static'])
+    parser.add_argument(
+        '--train-size', default=1, type=int, metavar='N',
+        help='send up to N packets of a flow as one packet train '
+             '(not for FAST)')
+    parser.add_argument(
+        '--scheduler', default='simpy',
+        choices=['simpy', 'kernel', 'calendar'])
+    parser.add_argument(
+        '--background', default='fluid', choices=['fluid', 'packet'],
+        help='how to simulate the flows marked as background')
+    parser.add_argument(
+        '--until-finished', action='store_true',
+        help='end once all flows have finished, and write their '
+             'completion times to standard error')
+    parser.add_argument(
+        '--steady', type=parse_batch, metavar='SECONDS',
+        help='end once the batch means over SECONDS of the flows and '
+             'links have settled, and write the warm-up cutoff to '
+             'standard error')
+    parser.add_argument(
+        '--steady-batches', default=5, type=parse_batches, metavar='N',
+        help='number of batches the steady state is judged by')
+    parser.add_argument(
+        '--steady-tol', default=0.05, type=float, metavar='TOL',
+        help='relative tolerance of the steady state')
+    args = parser.parse_args(argv)
 
-    if len(sys.argv) < 2:
-        sys.stderr.write(usage)
-        sys.exit(0)
+    trace_cls = trace_dict[args.trace]
+    if trace_cls is BinaryTracer:
+        tracer = BinaryTracer(getattr(sys.stdout, 'buffer', sys.stdout))
+    elif trace_cls is MetricCollector:
+        tracer = MetricCollector(sys.stdout, args.freq)
+    else:
+        tracer = trace_cls(sys.stdout)
 
-    try:
-        sim_time = float(sys.argv[1])
-
-        if len(sys.argv) > 2:
-            alg = alg_dict[sys.argv[2]]
+    sim = Network(
+        None, None, alg_dict[args.flow_alg], tracer=tracer,
+        routing=args.routing, train_size=args.train_size,
+        scheduler=args.scheduler, background=args.background)
+    monitor = None
+    if args.steady is not None:
+        monitor = SteadyStateMonitor(
+            sim, args.steady, args.steady_batches, args.steady_tol)
+    sim.run(args.sim_time, until_finished=args.until_finished)
+    tracer.close()
+    if args.until_finished:
+        times = sim.completion_times()
+        for name in sorted(times):
+            sys.stderr.write('{} {}\n'.format(
+                name, 'unfinished' if times[name] is None
+                else '{:.6f}'.format(times[name])))
+    if monitor is not None:
+        if monitor.warmup is None:
+            sys.stderr.write('steady state not reached\n')
         else:
-            alg = FastTCPFlow
-    except:
-        sys.stderr.write(usage)
-        sys.exit(0)
+            sys.stderr.write('warmup {:.6f}\n'.format(monitor.warmup))
+    if args.until_finished or monitor is not None:
+        sys.stderr.write('end {:.6f}\n'.format(sim.env.now))
 
-    sim = Network(None, None, alg)
-    sim.run(sim_time)
+if __name__ == '__main__':
+    main()
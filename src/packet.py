@@ -2,23 +2,57 @@ from __future__ import division, print_function
 from functools import partial
 from operator import attrgetter
 
-import simpy
 import random
-import copy
 
 class Packet(object):
-    """Base class for all kinds of packets."""
-    def __init__(self):
+    """Base class for all kinds of packets.
 
-        super(Packet, self).__init__()
+    Packets use __slots__ to keep per-packet memory small. Classes created
+    for every data packet also keep a free list of consumed instances,
+    which create() reuses before allocating new ones.
+    """
+
+    __slots__ = ()
 
     _size = 0
 
+    # Free list of released instances, or None if the class is not pooled
+    _pool = None
+    _pool_limit = 1 << 16
+
+    # Compiled Path the packet follows and the index of its current cable,
+    # for packets that support fast forwarding
+    path = None
+    hop = 0
+
+    # Number of data packets this packet stands for
+    count = 1
+
+    def release(self):
+        """Returns a consumed packet to the free list of its class.
+
+        Must only be called once nothing refers to the packet anymore, i.e.
+        after it has been delivered or dropped.
+        """
+        pool = self._pool
+        if pool is not None and len(pool) < self._pool_limit:
+            pool.append(self)
+
     @property
     def size(self):
         """Returns the size of packet in bytes."""
         return self._size
 
+    def split(self, room):
+        """Splits off the leading part of the packet that fits in <room>.
+
+        Returns:
+            A packet made of the leading data packets that fit in <room>
+            bytes, leaving the rest in this packet, or None if the packet
+            cannot be split.
+        """
+        return None
+
     def reach_router(self, router, port_id):
         raise NotImplementedError()
 
@@ -28,11 +62,17 @@ class Packet(object):
 class DataPacket(Packet):
     """Represents data sent from one source to another."""
 
+    __slots__ = (
+        'src', 'dest', 'flow_id', 'packet_no', 'timestamp', 'path', 'hop')
+
     _size = 1024
 
     payload_size = 1024
 
-    def __init__(self, src, dest, flow_id, packet_no, timestamp):
+    _pool = []
+
+    def __init__(
+        self, src, dest, flow_id, packet_no, timestamp, path=None):
         """Creates a data packet.
 
         Args:
@@ -41,13 +81,30 @@ class DataPacket(Packet):
             flow_id: Flow ID this packet belongs to.
             packet_no: Packet number.
             timestamp: Time when the packet was sent.
+            path: Compiled Path from src to dest, if any.
         """
-        super(DataPacket, self).__init__()
         self.src = src
         self.dest = dest
         self.flow_id = flow_id
         self.packet_no = packet_no
         self.timestamp = timestamp
+        self.path = path
+        self.hop = 0
+
+    @classmethod
+    def create(cls, src, dest, flow_id, packet_no, timestamp, path=None):
+        """Creates a data packet, reusing a released one if possible."""
+        if not cls._pool:
+            return cls(src, dest, flow_id, packet_no, timestamp, path)
+        p = cls._pool.pop()
+        p.src = src
+        p.dest = dest
+        p.flow_id = flow_id
+        p.packet_no = packet_no
+        p.timestamp = timestamp
+        p.path = path
+        p.hop = 0
+        return p
 
     def reach_router(self, router, port_id):
         """Visitor method called by Router object.
@@ -78,15 +135,106 @@ class DataPacket(Packet):
                 timestamp = self.timestamp
             else:
                 timestamp = None
-            host.send_except(AckPacket(
-                self.dest, self.src, self.flow_id, n, timestamp))
+            host.send_except(AckPacket.create(
+                self.dest, self.src, self.flow_id, n, timestamp,
+                host.path_to(self.src)))
+        self.release()
+
+class PacketTrain(DataPacket):
+    """Represents <count> consecutive data packets travelling back to back.
+
+    A train is queued and transmitted as a whole, and acknowledged by a
+    single AckPacket standing for <count> acknowledgements. Only a train
+    that overflows a buffer is split, in which case the tail is dropped.
+
+    Cables pass a train on as soon as its first packet has been sent, so
+    the train travels at the arrival time of its first packet. The gap
+    records how far apart its packets are by then. The timestamp is the
+    time when the last packet was sent.
+    """
+
+    __slots__ = ('count', 'gap')
+
+    _pool = None
+
+    def __init__(
+        self, src, dest, flow_id, packet_no, timestamp, count, path=None):
+        """Creates a packet train.
+
+        Args:
+            src: Host ID of the source.
+            dest: Host ID of the target.
+            flow_id: Flow ID this train belongs to.
+            packet_no: Packet number of the first packet.
+            timestamp: Time when the train was sent.
+            count: Number of data packets.
+            path: Compiled Path from src to dest, if any.
+        """
+        super(PacketTrain, self).__init__(
+            src, dest, flow_id, packet_no, timestamp, path)
+        self.count = count
+        self.gap = 0.0
+
+    @property
+    def size(self):
+        """Returns the size of the train in bytes."""
+        return self.count * self._size
+
+    def split(self, room):
+        n = int(room // self._size)
+        if n <= 0:
+            return None
+        head = PacketTrain(
+            self.src, self.dest, self.flow_id, self.packet_no,
+            self.timestamp, n, self.path)
+        head.hop = self.hop
+        head.gap = self.gap
+        self.packet_no += n
+        self.count -= n
+        return head
+
+    def reach_host(self, host):
+        """Visitor method called by Host object.
+
+        Instructs the calling host to acknowledge the whole train at once,
+        when its last packet has arrived.
+
+        Args:
+            host: The host this train arrives at.
+        """
+        timer = host.env.timeout((self.count - 1) * self.gap)
+        timer.callbacks.append(lambda event: self.acknowledge(host))
+
+    def acknowledge(self, host):
+        """Acknowledges the train once its last packet has arrived.
+
+        The AckPacket carries the gap between the packets of the train, so
+        that the source can pace its next train like ACK clocking would.
+        """
+        n = host.get_data(self.flow_id, self.packet_no, self.count)
+        if n is not None:
+            if n > self.packet_no:
+                timestamp = self.timestamp
+            else:
+                timestamp = None
+            host.send_except(AckPacket.create(
+                self.dest, self.src, self.flow_id, n, timestamp,
+                host.path_to(self.src), self.count, self.gap))
 
 class AckPacket(Packet):
     """Represents acknowledgement of a data packet."""
 
+    __slots__ = (
+        'src', 'dest', 'flow_id', 'packet_no', 'timestamp', 'path', 'hop',
+        'acks', 'gap')
+
     _size = 64
 
-    def __init__(self, src, dest, flow_id, packet_no, timestamp):
+    _pool = []
+
+    def __init__(
+        self, src, dest, flow_id, packet_no, timestamp, path=None, acks=1,
+        gap=0.0):
         """Creates an acknowledgement.
 
         Args:
@@ -95,13 +243,39 @@ class AckPacket(Packet):
             flow_id: Flow ID the data packet belongs to.
             packet_no: Acknowledgement number.
             timestamp: Time when the data packet was sent.
+            path: Compiled Path from src to dest, if any.
+            acks: Number of acknowledgements this one stands for.
+            gap: Time between the arrivals of the acknowledged packets.
         """
-        super(AckPacket, self).__init__()
         self.src = src
         self.dest = dest
         self.flow_id = flow_id
         self.packet_no = packet_no
         self.timestamp = timestamp
+        self.path = path
+        self.hop = 0
+        self.acks = acks
+        self.gap = gap
+
+    @classmethod
+    def create(
+        cls, src, dest, flow_id, packet_no, timestamp, path=None, acks=1,
+        gap=0.0):
+        """Creates an acknowledgement, reusing a released one if possible."""
+        if not cls._pool:
+            return cls(
+                src, dest, flow_id, packet_no, timestamp, path, acks, gap)
+        p = cls._pool.pop()
+        p.src = src
+        p.dest = dest
+        p.flow_id = flow_id
+        p.packet_no = packet_no
+        p.timestamp = timestamp
+        p.path = path
+        p.hop = 0
+        p.acks = acks
+        p.gap = gap
+        return p
 
     def reach_router(self, router, port_id):
         """Visitor method called by Router object.
@@ -116,7 +290,9 @@ class AckPacket(Packet):
         router.send(self, router.look_up(self.dest))
 
     def reach_host(self, host):
-        host.get_ack(self.flow_id, self.packet_no, self.timestamp)
+        host.get_ack(
+            self.flow_id, self.packet_no, self.timestamp, self.acks, self.gap)
+        self.release()
 
 class SonarPacket(Packet):
     """Signal for network exploration using Dijkstra's algorithm.
@@ -125,6 +301,8 @@ class SonarPacket(Packet):
     and keeps track of which port is the best for
     a specific host
     """
+    __slots__ = ('src', 'version')
+
     _size = 64
 
     def __init__(self, src, version):
@@ -134,7 +312,6 @@ class SonarPacket(Packet):
             src: The source host initiating network exploration.
             version: The round number of dynamic routing.
         """
-        super(SonarPacket, self).__init__()
         self.src = src
         self.version = version
 
@@ -152,7 +329,7 @@ class SonarPacket(Packet):
         src = self.src
         vtable = router.table_version
         version = self.version
-        if src not in vtable or vtable[src] < version:
+        if vtable[src] < version:
             vtable[src] = version
             router.table_reverse[src] = port_id
             router.send_except(self, port_id)
@@ -172,6 +349,8 @@ class EchoPacket(Packet):
 
     An EchoPacket is sent when a SonarPacket arrives to a host.
     """
+    __slots__ = ('src', 'dest', 'version')
+
     _size = 64
 
     def __init__(self, src, dest, version):
@@ -182,7 +361,6 @@ class EchoPacket(Packet):
             dest: The target host responding to incoming SonarPacket.
             version: The round number of dynamic routing.
         """
-        super(EchoPacket, self).__init__()
         self.src = src
         self.dest = dest
         self.version = version
@@ -200,8 +378,8 @@ class EchoPacket(Packet):
         """
         src = self.src
         vtable = router.table_version
-        if src in vtable and vtable[src] == self.version:
-            router.table_forward[self.dest] = port_id
+        if vtable[src] == self.version:
+            router.set_forward(self.dest, port_id)
             router.send(self, router.table_reverse[src])
 
     def reach_host(self, host):
@@ -221,6 +399,10 @@ class RoutingPacket(Packet):
     path to hosts.
     """
 
+    __slots__ = (
+        'start_id', 'recorded_time', 'end_id', 'passedTable',
+        'passedTimeTable', 'stat')
+
     _size = 64
 
     def __init__(self, start_id, recorded_time, static=False):
@@ -237,7 +419,6 @@ class RoutingPacket(Packet):
         Attributes:
 
         """
-        super(RoutingPacket, self).__init__()
         self.start_id = start_id
         self.recorded_time = recorded_time
         self.end_id = None
@@ -267,16 +448,17 @@ class RoutingPacket(Packet):
         """
         if self.stat:
             if self.start_id not in router.table:
-                router.table[self.start_id] = port_id
-                router.timeTable[self.start_id] = router.env.now - self.recorded_time
+                router.set_route(
+                    self.start_id, port_id,
+                    router.env.now - self.recorded_time)
             router.send_except(self, port_id)
         else:
             if self.start_id == router.dev_id:
                 if self.passedTable is None:
                     if self.end_id not in router.table \
                        or router.timeTable[self.end_id] >= self.recorded_time:
-                        router.table[self.end_id] = port_id
-                        router.timeTable[self.end_id] = self.recorded_time
+                        router.set_route(
+                            self.end_id, port_id, self.recorded_time)
                 else:
                     for host in self.passedTable:
                         if host not in router.timeTable or (
@@ -284,16 +466,18 @@ class RoutingPacket(Packet):
                             router.timeTable[host] >= 
                             (self.passedTimeTable[host] + self.recorded_time)
                         ):
-                            router.table[host] = port_id
                             if host in self.passedTimeTable:
-                                router.timeTable[host] = (
+                                router.set_route(host, port_id, (
                                     self.passedTimeTable[host] + 
-                                    self.recorded_time)
+                                    self.recorded_time))
                             else:
-                                router.timeTable[host] = self.recorded_time
+                                router.set_route(
+                                    host, port_id, self.recorded_time)
             else:
-                self.passedTable = copy.deepcopy(router.table)
-                self.passedTimeTable = copy.deepcopy(router.timeTable)
+                # Shares the tables with the router, which copies them
+                # before its next update
+                self.passedTable, self.passedTimeTable = \
+                    router.routing_snapshot()
                 self.recorded_time = router.env.now - self.recorded_time
                 router.send(self, port_id)
     
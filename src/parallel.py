@@ -0,0 +1,377 @@
+#!/usr/bin/env python
+from __future__ import division, print_function
+import argparse
+import cPickle as pickle
+import multiprocessing
+import sys
+
+from device import BufferedCable
+from flow import FastTCPFlow
+from kernel import Kernel
+from metrics import MetricCollector
+from network import Network, alg_dict
+
+class BoundaryCable(BufferedCable):
+    """Cable into a host or router simulated by another process.
+
+    Transmitted packets are posted to an outbox together with their
+    arrival time at the far end instead of entering the delay line. The
+    propagation delay is what lets the other process run ahead safely.
+    The Lineage of the propagation timer a serial run would make goes
+    with them, so that the other process orders their arrival among its
+    own timers like a serial run.
+
+    Attributes:
+        part: Number of the part the far end belongs to.
+        outbox: List of (part, arrival time, departure time, Lineage, link
+            ID, source ID, packet) tuples shared by all boundary cables of
+            a process.
+    """
+
+    def __init__(self, link, src_id, part, outbox):
+        super(BoundaryCable, self).__init__(link, src_id)
+        self.part = part
+        self.outbox = outbox
+
+    def _send_on(self, packet):
+        # Compiled paths do not leave the process
+        if packet.path is not None:
+            packet.path = None
+            packet.hop = 0
+        now = self.env.now
+        arrival = now + self.delay / 1.0E3
+        self.outbox.append((
+            self.part, arrival, now, self.env.reserve(arrival),
+            self.link_id, self.src_id, packet))
+
+class RemoteCable(BufferedCable):
+    """Far end of a BoundaryCable, in the process simulating the device
+    the cable leads to.
+
+    Packets posted from the other process go through the delay line of a
+    BufferedCable, so they are delivered in the same order as in a serial
+    run.
+    """
+
+    def post(self, arrival, departure, lineage, packet):
+        """Puts a packet sent at time <departure> into the delay line."""
+        self._delay_line.append((arrival, packet))
+        # A serial run arms the timer when the packet is transmitted
+        timer = self.env.schedule(arrival, departure, lineage)
+        timer.callbacks.append(self._propagate)
+
+class PartCollector(MetricCollector):
+    """MetricCollector of one part of a network.
+
+    The buffer level of a link between two parts depends on the events of
+    both, so the buffer changes of such links are kept as a list of
+    (time, link name, size) events for the coordinator to aggregate. The
+    timers whose callbacks made them are kept too, for the coordinator to
+    order the changes of a link made at the same time by both parts.
+
+    Attributes:
+        env: Kernel of the part, ordering timers by lineage.
+        cut: Set of names of the links between parts.
+        cut_events: Buffer changes of the links in <cut> in time order.
+        firings: Kernel.firing for each of <cut_events>.
+    """
+
+    def __init__(self, freq, cut):
+        super(PartCollector, self).__init__(freq=freq)
+        self.env = None
+        self.cut = frozenset(cut)
+        self.cut_events = []
+        self.firings = []
+
+    def emit(self, kind, now, *args):
+        if kind == 'buffer_diff' and args[0] in self.cut:
+            self.cut_events.append((now, args[0], args[1]))
+            self.firings.append(self.env.firing)
+        else:
+            super(PartCollector, self).emit(kind, now, *args)
+
+def partition(sim, n_parts):
+    """Splits the hosts and routers of a network into parts.
+
+    Links are cut in decreasing order of propagation delay, since the
+    smallest delay of a cut link bounds how far the parts can run ahead of
+    each other. Starting from single devices, the ends of the links are
+    merged shortest delay first, host links first among equal delays, as
+    long as no part grows beyond its share of the devices. The resulting
+    groups are then packed into <n_parts> parts, largest first.
+
+    Args:
+        sim: Network, which need not simulate any part of itself.
+        n_parts: Maximum number of parts.
+
+    Returns:
+        Dictionary mapping the IDs of hosts and routers to part numbers.
+    """
+    parent = dict((dev_id, dev_id) for dev_id in sim._node_ids)
+    size = dict((dev_id, 1) for dev_id in sim._node_ids)
+
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    limit = -(-len(parent) // n_parts)
+    is_host = lambda dev_id: dev_id < sim._n_hosts
+    for _, a, b, _, delay, _ in sorted(
+        sim._link_specs,
+        key=lambda spec: (
+            spec[4], not (is_host(spec[1]) or is_host(spec[2])))):
+        a, b = find(a), find(b)
+        if a != b and size[a] + size[b] <= limit:
+            parent[b] = a
+            size[a] += size[b]
+
+    groups = {}
+    for dev_id in sim._node_ids:
+        groups.setdefault(find(dev_id), []).append(dev_id)
+
+    loads = [0] * n_parts
+    parts = {}
+    for group in sorted(groups.values(), key=len, reverse=True):
+        part = loads.index(min(loads))
+        loads[part] += len(group)
+        for dev_id in group:
+            parts[dev_id] = part
+    return parts
+
+def lookahead(sim, parts):
+    """Smallest propagation delay of the links between parts in seconds,
+    or None if no link is cut."""
+    delays = [
+        delay / 1.0E3 for _, a, b, _, delay, _ in sim._link_specs
+        if parts[a] != parts[b]]
+    return min(delays) if delays else None
+
+def _worker(conn, filename, part, parts, cut, kwargs):
+    """Simulates one part of a network and syncs with the coordinator.
+
+    Each message from the coordinator is either None, to return the
+    collected metric bins and buffer events of cut links, or a (time,
+    parcels) pair, to deliver the packets in the parcels and run until
+    that time. After each run, the outbox is sent back as a dictionary
+    mapping parts to parcels, each a pickled list of the packets for that
+    part, which the coordinator passes on without unpickling the
+    lineages. The last message lists the buffer events whose firings to
+    return before exiting.
+    """
+    tracer = PartCollector(kwargs.pop('freq'), cut)
+    tracer.env = Kernel(event_list=kwargs.pop('event_list'), lineage=part)
+    sim = Network(tracer.env, filename, tracer=tracer, **kwargs)
+
+    outbox = []
+    remote = {}
+    for link_id, a, b, _, _, _ in sim._link_specs:
+        for src_id, dest_id in ((a, b), (b, a)):
+            if parts[src_id] == part and parts[dest_id] != part:
+                link = sim._nodes[link_id]
+                link._cables[src_id] = BoundaryCable(
+                    link, src_id, parts[dest_id], outbox)
+            elif parts[src_id] != part and parts[dest_id] == part:
+                remote[link_id, src_id] = RemoteCable(
+                    sim._nodes[link_id], src_id)
+
+    while True:
+        msg = conn.recv()
+        if msg is None:
+            break
+        until, parcels = msg
+        inbox = [post for parcel in parcels for post in pickle.loads(parcel)]
+        inbox.sort(key=lambda post: post[:3])
+        for arrival, departure, lineage, link_id, src_id, packet in inbox:
+            remote[link_id, src_id].post(
+                arrival, departure, lineage, packet)
+        sim.run(until)
+
+        posts = {}
+        for post in outbox:
+            posts.setdefault(post[0], []).append(post[1:])
+        conn.send(dict(
+            (dest, pickle.dumps(posts[dest], pickle.HIGHEST_PROTOCOL))
+            for dest in posts))
+        del outbox[:]
+
+    conn.send((tracer.bins, tracer.cut_events))
+    conn.send([tracer.firings[i] for i in conn.recv()])
+    conn.close()
+
+def run_parallel(
+    filename, sim_time, n_workers=None, algorithm=FastTCPFlow,
+    routing='dynamic', train_size=1, event_list='heap', freq=5,
+    stream=None):
+    """Simulates a network on several processes.
+
+    The network is split by partition() and each part is simulated by its
+    own process and event loop. Packets crossing between parts are
+    exchanged in time windows as long as the smallest propagation delay of
+    the cut links: a packet sent during a window cannot arrive before the
+    next one, so no process ever receives a packet from its past
+    (conservative synchronization).
+
+    Each process orders its timers by Lineage, and packets crossing
+    between parts carry the lineage of their propagation timer, so events
+    at the same instant happen in the order of a serial run on a Kernel,
+    and so does the choice between routes of equal cost. The metric bins
+    of the parts are merged into the same series as a serial run with
+    MetricCollector produces. Only ties whose timers go back further
+    than Lineage.depth timers to a common one may be ordered differently.
+
+    Flows marked as background in the network file are simulated as
+    packets like the others.
+
+    Args:
+        filename: Network file.
+        sim_time: Simulated time in seconds.
+        n_workers: Number of processes, defaults to the number of CPUs.
+        algorithm, routing, train_size: As for Network.
+        event_list: Event list of the Kernel of each process.
+        freq: Bins per second.
+        stream: File object the merged series is written to when the
+            returned collector is closed.
+
+    Returns:
+        MetricCollector holding the merged bins.
+    """
+    collector = MetricCollector(stream, freq)
+    sim = Network(None, filename, tracer=collector, local=())
+
+    if n_workers is None:
+        n_workers = multiprocessing.cpu_count()
+    n_workers = max(1, min(n_workers, len(sim._node_ids)))
+    parts = partition(sim, n_workers)
+    window = lookahead(sim, parts)
+    if window is None:
+        window = sim_time
+    elif window <= 0:
+        raise ValueError('Links between parts need a positive delay')
+
+    cut = [
+        sim.names[link_id] for link_id, a, b, _, _, _ in sim._link_specs
+        if parts[a] != parts[b]]
+    kwargs = dict(
+        algorithm=algorithm, routing=routing, train_size=train_size,
+        event_list=event_list, background='packet', freq=freq)
+    conns = []
+    workers = []
+    for part in sorted(set(parts.values())):
+        local = [
+            sim.names[dev_id] for dev_id in sim._node_ids
+            if parts[dev_id] == part]
+        conn, child_conn = multiprocessing.Pipe()
+        w = multiprocessing.Process(
+            target=_worker,
+            args=(child_conn, filename, part, parts, cut,
+                  dict(kwargs, local=local)))
+        w.daemon = True
+        w.start()
+        # Lets recv() fail instead of hanging if the worker dies
+        child_conn.close()
+        conns.append(conn)
+        workers.append(w)
+
+    try:
+        now = 0.0
+        inboxes = [[] for _ in conns]
+        while now < sim_time:
+            until = min(sim_time, now + window)
+            for conn, inbox in zip(conns, inboxes):
+                conn.send((until, inbox))
+            inboxes = [[] for _ in conns]
+            for conn in conns:
+                for dest, parcel in conn.recv().iteritems():
+                    inboxes[dest].append(parcel)
+            now = until
+
+        for conn in conns:
+            conn.send(None)
+        cut_events = []
+        for part, conn in enumerate(conns):
+            bins, events = conn.recv()
+            collector.merge(bins)
+            cut_events.extend(
+                (now, part, i, link, size)
+                for i, (now, link, size) in enumerate(events))
+
+        # Changes of a link made at the same time by both parts go in the
+        # order of the timers that made them
+        ends = {}
+        for now, part, _, link, _ in cut_events:
+            ends.setdefault((now, link), set()).add(part)
+        ties = [[] for _ in conns]
+        for now, part, i, link, _ in cut_events:
+            if len(ends[now, link]) > 1:
+                ties[part].append(i)
+        for conn, indices in zip(conns, ties):
+            conn.send(indices)
+        firings = {}
+        for part, (conn, indices) in enumerate(zip(conns, ties)):
+            for i, firing in zip(indices, conn.recv()):
+                firings[part, i] = firing
+
+        changes = sorted(
+            (now, firings.get((part, i)), part, i, link, size)
+            for now, part, i, link, size in cut_events)
+
+        # Like BufferedCable.feed(), which cannot see departures in the
+        # other part, log increases after the departures due at the time
+        last_release = {}
+        for pos, (now, _, _, _, link, size) in enumerate(changes):
+            if size < 0:
+                last_release[now, link] = pos
+        deferred = {}
+
+        # Replay the buffer changes of the cut links of all parts at once
+        cut_collector = MetricCollector(freq=freq)
+        for pos, (now, _, _, _, link, size) in enumerate(changes):
+            last = last_release.get((now, link))
+            if size > 0 and last is not None and last > pos:
+                deferred.setdefault((now, link), []).append(size)
+                continue
+            cut_collector.emit('buffer_diff', now, link, size)
+            if last == pos:
+                for queued in deferred.pop((now, link), ()):
+                    cut_collector.emit('buffer_diff', now, link, queued)
+        collector.merge(cut_collector.bins)
+    finally:
+        for w in workers:
+            w.join(1)
+            if w.is_alive():
+                w.terminate()
+    return collector
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Simulate a network on several processes and write '
+                    'its metrics like process.py.')
+    parser.add_argument('filename')
+    parser.add_argument('sim_time', type=float)
+    parser.add_argument(
+        'flow_alg', nargs='?', default='fast', choices=sorted(alg_dict))
+    parser.add_argument(
+        'freq', nargs='?', default=5, type=int, help='bins per second')
+    parser.add_argument(
+        '--workers', type=int, metavar='N',
+        help='number of processes (default: number of CPUs)')
+    parser.add_argument(
+        '--routing', default='dynamic', choices=['dynamic', 'static'])
+    parser.add_argument(
+        '--train-size', default=1, type=int, metavar='N',
+        help='send up to N packets of a flow as one packet train '
+             '(not for FAST)')
+    parser.add_argument(
+        '--event-list', default='heap', choices=['heap', 'calendar'])
+    args = parser.parse_args(argv)
+
+    collector = run_parallel(
+        args.filename, args.sim_time, args.workers, alg_dict[args.flow_alg],
+        routing=args.routing, train_size=args.train_size,
+        event_list=args.event_list, freq=args.freq, stream=sys.stdout)
+    collector.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+from __future__ import division, print_function
+import argparse
+import itertools
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+
+from network import Network, alg_dict
+from metrics import MetricCollector
+from sweep import parse_override
+
+def fork_variants(
+    sim, variants, sim_time, out_dir, processes=None, progress=None):
+    """Continues a warmed-up simulation once per variant.
+
+    Each variant runs in a process forked from this one, so it starts
+    from the state <sim> is in without parsing the network file, routing
+    and slow start again. Memory is shared copy-on-write until a variant
+    changes it. <sim> must trace into a MetricCollector, whose bins up to
+    the fork are part of the output of every variant.
+
+    Args:
+        sim: Network that has been run up to the warm-up time.
+        variants: List of (name, setup) pairs, where setup is a function
+            called with the Network in the forked process to change it
+            before it continues, e.g. by calling switch_algorithm().
+            Names must be unique, as variant_grid() makes them.
+        sim_time: Simulated time in seconds to continue until.
+        out_dir: Directory the series of variant <name> is written to as
+            <name>.txt, created if needed.
+        processes: Maximum number of variants running at the same time,
+            defaults to the number of CPUs.
+        progress: File object for progress lines, defaults to stderr.
+
+    Returns:
+        Names of the variants that failed.
+    """
+    names = [name for name, _ in variants]
+    if len(set(names)) < len(names):
+        raise ValueError('Variant names are not unique')
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if progress is None:
+        progress = sys.stderr
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    # Buffered output would be written once by every process
+    sim.tracer.flush()
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    pending = list(variants)
+    running = {}
+    failed = []
+    done = 0
+    while pending or running:
+        while pending and len(running) < processes:
+            name, setup = pending.pop(0)
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    path = os.path.join(out_dir, name + '.txt')
+                    with open(path, 'w') as stream:
+                        sim.tracer.stream = stream
+                        setup(sim)
+                        sim.run(sim_time)
+                        sim.tracer.close()
+                    status = 0
+                except Exception:
+                    traceback.print_exc()
+                finally:
+                    sys.stderr.flush()
+                    os._exit(status)
+            running[pid] = (name, time.time())
+
+        pid, status = os.wait()
+        name, start = running.pop(pid)
+        done += 1
+        if status:
+            failed.append(name)
+        progress.write('[{}/{}] {} {} ({:.1f} s)\n'.format(
+            done, len(variants), name, 'FAILED' if status else 'ok',
+            time.time() - start))
+        progress.flush()
+    return failed
+
+def variant_grid(algorithms, overrides):
+    """Variants for fork_variants() over all combinations of flow
+    algorithms and link parameter values.
+
+    Args:
+        algorithms: Names of flow algorithms in alg_dict to switch to, or
+            an empty list to keep the algorithm.
+        overrides: List of (link name or '*', parameter, values) tuples
+            as parsed by sweep.parse_override().
+
+    Returns:
+        List of (name, setup) pairs. Variants that would share a name,
+        such as those of values equal to the precision of the name, get a
+        numbered suffix.
+    """
+    variants = []
+    counts = {}
+    for algorithm, values in itertools.product(
+        algorithms or [None],
+        itertools.product(*[values for _, _, values in overrides])):
+        link_params = {}
+        labels = [algorithm] if algorithm is not None else []
+        for (link, param, _), value in zip(overrides, values):
+            link_params.setdefault(link, {})[param] = value
+            labels.append('{}{}={:g}'.format(
+                '' if link == '*' else link + '.', param, value))
+
+        def setup(sim, algorithm=algorithm, link_params=link_params):
+            if algorithm is not None:
+                sim.switch_algorithm(alg_dict[algorithm])
+            sim.configure_links(link_params)
+
+        name = '_'.join(labels) or 'unchanged'
+        counts[name] = counts.get(name, 0) + 1
+        if counts[name] > 1:
+            name += '_{}'.format(counts[name])
+        variants.append((name, setup))
+    return variants
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Simulate a network up to a warm-up time, then fork '
+                    'a process for each variant of the rest of the run.')
+    parser.add_argument('filename')
+    parser.add_argument('warm_up', type=float, help='warm-up time')
+    parser.add_argument('sim_time', type=float)
+    parser.add_argument(
+        'flow_alg', nargs='?', default='fast', choices=sorted(alg_dict),
+        help='flow algorithm during the warm-up')
+    parser.add_argument(
+        '--algs', nargs='+', default=[], choices=sorted(alg_dict),
+        help='flow algorithms to switch to after the warm-up')
+    parser.add_argument(
+        '--set', action='append', default=[], type=parse_override,
+        metavar='[LINK.]PARAM=V1,V2', dest='overrides',
+        help='link parameter (rate or buf_size) to change after the '
+             'warm-up')
+    parser.add_argument('--out', default='fork', help='output directory')
+    parser.add_argument(
+        '--processes', type=int, help='default: number of CPUs')
+    parser.add_argument(
+        '--freq', default=5, type=int, help='bins per second')
+    parser.add_argument(
+        '--routing', default='dynamic', choices=['dynamic', 'static'])
+    parser.add_argument(
+        '--train-size', default=1, type=int, metavar='N',
+        help='send up to N packets of a flow as one packet train '
+             '(not for FAST)')
+    parser.add_argument(
+        '--scheduler', default='kernel',
+        choices=['simpy', 'kernel', 'calendar'])
+    args = parser.parse_args(argv)
+    for _, param, _ in args.overrides:
+        if param == 'delay':
+            parser.error('link delays cannot be changed after the warm-up')
+
+    sim = Network(
+        None, args.filename, alg_dict[args.flow_alg],
+        tracer=MetricCollector(freq=args.freq), routing=args.routing,
+        train_size=args.train_size, scheduler=args.scheduler)
+    sim.run(args.warm_up)
+
+    variants = variant_grid(args.algs, args.overrides)
+    failed = fork_variants(
+        sim, variants, args.sim_time, args.out, args.processes)
+    if failed:
+        sys.exit('{} of {} variants failed'.format(
+            len(failed), len(variants)))
+
+if __name__ == '__main__':
+    main()
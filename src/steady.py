@@ -0,0 +1,203 @@
+from __future__ import division, print_function
+import argparse
+from collections import defaultdict, deque
+from math import sqrt
+
+from packet import DataPacket
+
+# Two-sided 95% quantiles of Student's t distribution by degrees of freedom,
+# beyond which the normal quantile is close enough
+_T95 = [
+    None, 12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262,
+    2.228, 2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093,
+    2.086, 2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045,
+    2.042]
+
+class SteadyStateMonitor(object):
+    """Detects when a simulation has reached a steady state.
+
+    The window size and throughput of every sending flow and the buffer
+    occupancy of every link are sampled <samples> times per batch of
+    <batch> seconds and averaged into batch means, which are nearly
+    independent when batches are longer than the oscillations of the
+    windows. The network is in a steady state once no flow has started
+    during the last <batches> batches and, for every series, both the
+    half-width of the 95% confidence interval of the mean of those batch
+    means and the drift between the means of their two halves are within
+    <tol> of the scale of the series: its mean for windows and
+    throughputs, or the buffer capacity for the buffer occupancy of a
+    link. Only the series of flows that sent during all of those batches
+    are checked, so flows that finish do not hold back the detection.
+
+    The first of those batches starts at the end of the warm-up, so
+    metrics of the steady state are those collected after <warmup>.
+
+    Attributes:
+        sim: Network being monitored.
+        batch: Length of a batch in seconds.
+        batches: Number of batch means the steady state is judged by, at
+            least 2.
+        tol: Largest confidence half-width and drift allowed, relative to
+            the scale of a series.
+        stop: Whether to end the simulation once the steady state is
+            reached.
+        warmup: Time in seconds the steady state started, or None if it
+            has not been detected.
+        steady_time: Time in seconds the steady state was detected, or
+            None.
+    """
+
+    def __init__(self, sim, batch=1.0, batches=5, tol=0.05, samples=20,
+                 stop=True):
+        """
+        Args:
+            sim: Network to monitor, before it runs.
+            batch, batches, tol, stop: As the attributes.
+            samples: Number of samples taken per batch.
+        """
+        if batch <= 0:
+            raise ValueError('Batch length must be positive')
+        if batches < 2:
+            raise ValueError('At least 2 batches are needed')
+        if samples < 1:
+            raise ValueError('At least 1 sample per batch is needed')
+        self.sim = sim
+        self.env = sim.env
+        self.batch = batch
+        self.batches = batches
+        self.tol = tol
+        self.stop = stop
+        self.warmup = None
+        self.steady_time = None
+
+        self._interval = batch / samples
+        self._samples = samples
+        self._links = [
+            (l.name, list(l._cables.values()),
+             sum(c.buf_size for c in l._cables.values()))
+            for l in sim.links]
+        # Batch means of each (metric, name) series, and their scales
+        self._means = {}
+        self._scale = {}
+        self._new_batch()
+
+        timer = self.env.timeout(self._interval)
+        timer.callbacks.append(self._sample)
+
+    def _new_batch(self):
+        self._taken = 0
+        self._window_sum = defaultdict(float)
+        self._window_count = defaultdict(int)
+        self._buffer_sum = defaultdict(int)
+        # Packets acknowledged by each sending flow when the batch began
+        self._acked = dict(
+            (f.name, f.window.offset) for f in self._sending())
+
+    def _sending(self):
+        now = self.env.now
+        return [f for f in self.sim.flows
+                if f.start <= now and f.finish_time is None]
+
+    def _sample(self, event):
+        """Samples every series and closes the batch after the last
+        sample."""
+        for f in self._sending():
+            self._window_sum[f.name] += f.cwnd
+            self._window_count[f.name] += 1
+        for name, cables, _ in self._links:
+            self._buffer_sum[name] += sum(c.buffer_level for c in cables)
+        self._taken += 1
+
+        if self._taken == self._samples:
+            self._end_batch()
+            if self.steady_time is not None:
+                if self.stop:
+                    self.sim.stop()
+                return
+            self._new_batch()
+
+        timer = self.env.timeout(self._interval)
+        timer.callbacks.append(self._sample)
+
+    def _append(self, key, value, scale):
+        means = self._means.get(key)
+        if means is None:
+            means = self._means[key] = deque(maxlen=self.batches)
+        means.append(value)
+        self._scale[key] = scale
+
+    def _end_batch(self):
+        samples = self._samples
+        sending = set()
+        for f in self._sending():
+            name = f.name
+            if self._window_count[name] < samples or name not in self._acked:
+                continue
+            sending.add(name)
+            self._append(('window_size', name),
+                         self._window_sum[name] / samples, 1.0)
+            self._append(('throughput', name),
+                         (f.window.offset - self._acked[name]) *
+                         DataPacket.payload_size * 8 / 1.0E6 / self.batch,
+                         0.0)
+        for name, _, buf_size in self._links:
+            self._append(('buf_level', name),
+                         self._buffer_sum[name] / samples / 1000,
+                         buf_size / 1000)
+
+        # Flows that did not send during the whole batch start over
+        for key in list(self._means):
+            if key[0] != 'buf_level' and key[1] not in sending:
+                del self._means[key]
+
+        if self._steady():
+            now = self.env.now
+            self.steady_time = now
+            self.warmup = now - self.batches * self.batch
+
+    def _steady(self):
+        # Flows starting during the batches change the steady state
+        since = self.env.now - self.batches * self.batch
+        if all(key[0] == 'buf_level' for key in self._means) or \
+           any(f.start > since for f in self.sim.flows):
+            return False
+        k = self.batches
+        t = _T95[k - 1] if k - 1 < len(_T95) else 1.96
+        for key, means in self._means.items():
+            if len(means) < k:
+                return False
+            mean = sum(means) / k
+            var = sum((m - mean) ** 2 for m in means) / (k - 1)
+            first = list(means)[:k // 2]
+            last = list(means)[k - k // 2:]
+            drift = abs(sum(last) - sum(first)) / (k // 2)
+            limit = self.tol * max(abs(mean), self._scale[key])
+            if t * sqrt(var / k) > limit or drift > limit:
+                return False
+        return True
+
+    def means(self):
+        """Means of the series over the batches of the steady state.
+
+        Returns:
+            Dictionary mapping (metric, name) tuples to means: metric
+            'window_size' in packets and 'throughput' in Mbps of
+            acknowledged data for flows, and 'buf_level' in KB for links.
+        """
+        return dict((key, sum(means) / len(means))
+                    for key, means in self._means.items() if means)
+
+def parse_batch(text):
+    """Parses a positive batch length in seconds."""
+    value = float(text)
+    if value <= 0:
+        raise argparse.ArgumentTypeError(
+            'batch length must be positive')
+    return value
+
+def parse_batches(text):
+    """Parses a number of batches of at least 2."""
+    value = int(text)
+    if value < 2:
+        raise argparse.ArgumentTypeError('at least 2 batches are needed')
+    return value
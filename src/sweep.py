@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+from __future__ import division, print_function
+import argparse
+import itertools
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+
+from network import Network, alg_dict
+from metrics import MetricCollector
+from steady import SteadyStateMonitor, parse_batch, parse_batches
+
+def grid(filenames, algorithms, overrides=(), sim_times=(20.0,)):
+    """Runs of a sweep over all combinations of the given values.
+
+    Args:
+        filenames: Network files.
+        algorithms: Names of flow algorithms in alg_dict.
+        overrides: List of (link name or '*', parameter, values) tuples,
+            one per swept link parameter.
+        sim_times: Simulated times in seconds.
+
+    Returns:
+        List of runs, each a dictionary with the keys 'filename',
+        'algorithm', 'link_params' and 'sim_time' and a unique 'name'.
+        Runs that would share a name, such as those of network files with
+        the same name in different directories, get a numbered suffix.
+    """
+    runs = []
+    counts = {}
+    for filename, algorithm, values, sim_time in itertools.product(
+        filenames, algorithms,
+        itertools.product(*[values for _, _, values in overrides]),
+        sim_times):
+        link_params = {}
+        labels = [os.path.splitext(os.path.basename(filename))[0], algorithm]
+        for (link, param, _), value in zip(overrides, values):
+            link_params.setdefault(link, {})[param] = value
+            labels.append('{}{}={:g}'.format(
+                '' if link == '*' else link + '.', param, value))
+        labels.append('{:g}s'.format(sim_time))
+        name = '_'.join(labels)
+        counts[name] = counts.get(name, 0) + 1
+        if counts[name] > 1:
+            name += '_{}'.format(counts[name])
+        runs.append({
+            'name': name,
+            'filename': filename,
+            'algorithm': algorithm,
+            'link_params': link_params,
+            'sim_time': sim_time})
+    return runs
+
+def run_one(run, out_dir, options):
+    """Simulates one run and writes its metrics to <out_dir>/<name>.txt.
+
+    With the 'steady' option, the run ends at its steady state, whose
+    warm-up cutoff is returned.
+
+    Returns:
+        (run name, wall time in seconds, error message or None, warm-up
+        cutoff in seconds or None)
+    """
+    start = time.time()
+    path = os.path.join(out_dir, run['name'] + '.txt')
+    warmup = None
+    try:
+        with open(path, 'w') as stream:
+            tracer = MetricCollector(stream, options['freq'])
+            sim = Network(
+                None, run['filename'], alg_dict[run['algorithm']],
+                tracer=tracer, routing=options['routing'],
+                train_size=options['train_size'],
+                scheduler=options['scheduler'],
+                link_params=run['link_params'])
+            monitor = None
+            if options['steady'] is not None:
+                monitor = SteadyStateMonitor(
+                    sim, options['steady'], options['steady_batches'],
+                    options['steady_tol'])
+            sim.run(run['sim_time'])
+            tracer.close()
+            if monitor is not None:
+                warmup = monitor.warmup
+    except Exception:
+        return (run['name'], time.time() - start, traceback.format_exc(),
+                None)
+    return run['name'], time.time() - start, None, warmup
+
+def _run_one(args):
+    return run_one(*args)
+
+def sweep(runs, out_dir, processes=None, progress=None, **options):
+    """Simulates <runs> on a pool of worker processes.
+
+    Each run streams its binned metrics, as written by MetricCollector, to
+    its own file in <out_dir>. A line is written to <progress> whenever a
+    run completes.
+
+    Args:
+        runs: Runs as returned by grid().
+        out_dir: Directory for the output files, created if needed.
+        processes: Number of worker processes, defaults to the number of
+            CPUs.
+        progress: File object for progress lines, defaults to stderr.
+        options: freq, routing, train_size and scheduler of all runs,
+            and steady, the batch length in seconds to end each run at
+            its steady state, with steady_batches and steady_tol as for
+            SteadyStateMonitor.
+
+    Returns:
+        Names of the runs that failed.
+    """
+    if progress is None:
+        progress = sys.stderr
+    options = dict(
+        dict(freq=5, routing='dynamic', train_size=1, scheduler='kernel',
+             steady=None, steady_batches=5, steady_tol=0.05),
+        **options)
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    failed = []
+    start = time.time()
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.imap_unordered(
+            _run_one, [(run, out_dir, options) for run in runs])
+        for done, (name, seconds, error, warmup) in enumerate(results, 1):
+            status = 'ok' if error is None else 'FAILED'
+            if warmup is not None:
+                status += ', steady after {:g} s'.format(warmup)
+            progress.write('[{}/{}] {} {} ({:.1f} s, {:.0f} s elapsed)\n'
+                .format(done, len(runs), name, status, seconds,
+                        time.time() - start))
+            if error is not None:
+                progress.write(error)
+                failed.append(name)
+            progress.flush()
+    except:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+    return failed
+
+def parse_override(text):
+    """Parses [LINK.]PARAM=V1,V2,... into (link or '*', param, values)."""
+    key, _, values = text.partition('=')
+    link, _, param = key.rpartition('.')
+    if param not in Network._link_fields or not values:
+        raise argparse.ArgumentTypeError(
+            'expected [LINK.]PARAM=V1,V2,... with PARAM one of {}'.format(
+                ', '.join(Network._link_fields)))
+    return link or '*', param, [float(v) for v in values.split(',')]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Simulate every combination of network files, flow '
+                    'algorithms and link parameters on all CPUs.')
+    parser.add_argument('filenames', nargs='+', metavar='FILE')
+    parser.add_argument(
+        '--algs', nargs='+', default=['fast'], choices=sorted(alg_dict))
+    parser.add_argument(
+        '--set', action='append', default=[], type=parse_override,
+        metavar='[LINK.]PARAM=V1,V2', dest='overrides',
+        help='sweep a link parameter (rate, delay or buf_size) of one or '
+             'all links')
+    parser.add_argument(
+        '--time', nargs='+', type=float, default=[20.0], metavar='SECONDS')
+    parser.add_argument('--out', default='sweep', help='output directory')
+    parser.add_argument(
+        '--processes', type=int, help='default: number of CPUs')
+    parser.add_argument(
+        '--freq', default=5, type=int, help='bins per second')
+    parser.add_argument(
+        '--routing', default='dynamic', choices=['dynamic', 'static'])
+    parser.add_argument(
+        '--train-size', default=1, type=int, metavar='N',
+        help='send up to N packets of a flow as one packet train '
+             '(not for FAST)')
+    parser.add_argument(
+        '--scheduler', default='kernel',
+        choices=['simpy', 'kernel', 'calendar'])
+    parser.add_argument(
+        '--steady', type=parse_batch, metavar='SECONDS',
+        help='end each run once the batch means over SECONDS of its flows '
+             'and links have settled, within --time at most')
+    parser.add_argument(
+        '--steady-batches', default=5, type=parse_batches, metavar='N',
+        help='number of batches the steady state is judged by')
+    parser.add_argument(
+        '--steady-tol', default=0.05, type=float, metavar='TOL',
+        help='relative tolerance of the steady state')
+    args = parser.parse_args(argv)
+
+    runs = grid(args.filenames, args.algs, args.overrides, args.time)
+    failed = sweep(
+        runs, args.out, args.processes, freq=args.freq,
+        routing=args.routing, train_size=args.train_size,
+        scheduler=args.scheduler, steady=args.steady,
+        steady_batches=args.steady_batches, steady_tol=args.steady_tol)
+    if failed:
+        sys.exit('{} of {} runs failed'.format(len(failed), len(runs)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+"""Checks that the trace backends and the in-memory metrics agree with the
+text log and process.py.
+
+Run from this directory with: python -m unittest discover
+"""
+from __future__ import division, print_function
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from metrics import MetricCollector
+from network import Network
+from tracer import TextTracer, BinaryTracer, replay
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TESTCASES = [
+    os.path.join(HERE, '..', 'testcases', 'tc{}.txt'.format(i))
+    for i in range(3)]
+SIM_TIME = 5.0
+
+def simulate(filename, tracer, **kwargs):
+    """Runs the network of <filename> for SIM_TIME seconds into <tracer>."""
+    sim = Network(None, filename, tracer=tracer, **kwargs)
+    sim.run(SIM_TIME)
+    tracer.close()
+
+def text_trace(filename, **kwargs):
+    """Text log of the network of <filename>."""
+    stream = tempfile.TemporaryFile()
+    simulate(filename, TextTracer(stream), **kwargs)
+    stream.seek(0)
+    return stream.read()
+
+class TraceReplayTest(unittest.TestCase):
+    """A binary trace replayed as text is the text trace."""
+
+    def test_binary_round_trip(self):
+        for filename in TESTCASES:
+            binary = tempfile.TemporaryFile()
+            simulate(filename, BinaryTracer(binary))
+            binary.seek(0)
+            text = tempfile.TemporaryFile()
+            replay(binary, TextTracer(text))
+            text.seek(0)
+            expected = text_trace(filename)
+            self.assertIn('buffer_diff', expected)
+            self.assertEqual(text.read(), expected, filename)
+
+class MetricCollectorTest(unittest.TestCase):
+    """MetricCollector writes what process.py makes of the text log."""
+
+    def process(self, log):
+        """Output of process.py for the text log <log>."""
+        stream = tempfile.TemporaryFile()
+        stream.write(log)
+        stream.seek(0)
+        return subprocess.check_output(
+            [sys.executable, os.path.join(HERE, 'process.py')],
+            stdin=stream)
+
+    def test_same_as_process(self):
+        for filename in TESTCASES:
+            expected = self.process(text_trace(filename))
+            self.assertTrue(expected)
+            stream = tempfile.TemporaryFile()
+            simulate(filename, MetricCollector(stream))
+            stream.seek(0)
+            self.assertEqual(stream.read(), expected, filename)
+
+    def test_replay_into_collector(self):
+        for filename in TESTCASES:
+            binary = tempfile.TemporaryFile()
+            simulate(filename, BinaryTracer(binary))
+            binary.seek(0)
+            stream = tempfile.TemporaryFile()
+            collector = MetricCollector(stream)
+            replay(binary, collector)
+            collector.close()
+            stream.seek(0)
+            self.assertEqual(
+                stream.read(), self.process(text_trace(filename)), filename)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+"""Checks that the schedulers and parallel.py simulate exactly the same
+events as a serial run on SimPy.
+
+Run from this directory with: python -m unittest discover
+"""
+from __future__ import division, print_function
+import tempfile
+import unittest
+
+from flow import TCPRenoFlow
+from metrics import MetricCollector
+from parallel import run_parallel
+from test_metrics import TESTCASES, SIM_TIME, simulate, text_trace
+
+class SchedulerTest(unittest.TestCase):
+    """The Kernel, with either event list, traces what SimPy traces."""
+
+    def test_same_trace(self):
+        for filename in TESTCASES:
+            for algorithm in (None, TCPRenoFlow):
+                kwargs = {'algorithm': algorithm} if algorithm else {}
+                expected = text_trace(filename, **kwargs)
+                for scheduler in ('kernel', 'calendar'):
+                    self.assertEqual(
+                        text_trace(filename, scheduler=scheduler, **kwargs),
+                        expected, (filename, algorithm, scheduler))
+
+class ParallelTest(unittest.TestCase):
+    """run_parallel() writes the metrics of a serial run on a Kernel."""
+
+    def serial(self, filename, routing):
+        stream = tempfile.TemporaryFile()
+        simulate(
+            filename, MetricCollector(stream), scheduler='kernel',
+            routing=routing)
+        stream.seek(0)
+        return stream.read()
+
+    def parallel(self, filename, routing, n_workers):
+        stream = tempfile.TemporaryFile()
+        run_parallel(
+            filename, SIM_TIME, n_workers, routing=routing,
+            stream=stream).close()
+        stream.seek(0)
+        return stream.read()
+
+    def test_static_routing(self):
+        for filename in TESTCASES:
+            self.assertEqual(
+                self.parallel(filename, 'static', 2),
+                self.serial(filename, 'static'), filename)
+
+    def test_dynamic_routing(self):
+        for filename in TESTCASES:
+            expected = self.serial(filename, 'dynamic')
+            for n_workers in (2, 3):
+                self.assertEqual(
+                    self.parallel(filename, 'dynamic', n_workers), expected,
+                    (filename, n_workers))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+from __future__ import division, print_function
+from array import array
+import struct
+import sys
+
+# Every traced event kind with its text format and argument schema. The
+# position in this list is the event code used by the binary backend.
+#
+# Schema letters: 'e' is an entity name (host, link, flow or state label),
+# 'i' is an integer and 'f' is a real number.
+EVENTS = [
+    ('send_data',       '{:.6f} send_data {} {} {} {}',     'eeii'),
+    ('receive_data',    '{:.6f} receive_data {} {} {}',     'eei'),
+    ('send_ack',        '{:.6f} send_ack {} {} {}',         'eei'),
+    ('receive_ack',     '{:.6f} receive_ack {} {} {}',      'eei'),
+    ('buffer_diff',     '{:.6f} buffer_diff {} {}',         'ei'),
+    ('packet_loss',     '{:.6f} packet_loss {} {} {}',      'eei'),
+    ('transmission',    '{:.6f} transmission {} {}',        'ei'),
+    ('ssthresh',        '{:.6f} ssthresh {} {:.3f}',        'ef'),
+    ('state',           '{:.6f} state {} {}',               'ee'),
+    ('window_size',     '{:.6f} window_size {} {:.3f}',     'ef'),
+    ('timeout',         '{:.6f} timeout {}',                'i'),
+    ('dupack',          '{:.6f} dupack {} {}',              'if'),
+    ('packet_rtt',      '{:.6f} packet_rtt {} {}',          'ef'),
+    ('retransmit',      '{:.6f} retransmit {} {}',          'ei'),
+    ('finish',          '{:.6f} finish {}',                 'e'),
+]
+
+EVENT_CODES = dict((e[0], i) for i, e in enumerate(EVENTS))
+
+# Metrics that can be requested in the output selection of a topology file,
+# with the event kind each one is computed from and the position of the
+# selected entity among the event arguments.
+METRICS = [
+    ('flow_send_rate',      'send_data',    0),
+    ('host_send_rate',      'send_data',    1),
+    ('packet_loss_rate',    'packet_loss',  0),
+    ('packet_rtt',          'packet_rtt',   0),
+    ('link_flow_rate',      'transmission', 0),
+    ('buf_level',           'buffer_diff',  0),
+    ('window_size',         'window_size',  0),
+]
+
+class IdentityNames(object):
+    """Name table for entities whose IDs are their names."""
+
+    def __getitem__(self, entity_id):
+        return entity_id
+
+class Tracer(object):
+    """Sink for simulation events.
+
+    Devices and flows call emit() with the event kind, the current
+    simulation time and the raw event arguments. Backends decide how
+    (and whether) the event is recorded.
+
+    Attributes:
+        selection: Dictionary mapping metric names to the entity IDs whose
+            events are needed, or None if every event is traced.
+    """
+
+    selection = None
+
+    def select(self, selection):
+        """Restricts tracing to the events needed by the given metrics.
+
+        Events that do not feed any metric are dropped altogether.
+
+        Args:
+            selection: Dictionary mapping names in METRICS to entity IDs.
+        """
+        self.selection = dict(
+            (k, frozenset(v)) for k, v in selection.items())
+
+    def enabled(self, kind, *entities):
+        """Whether an event should be emitted at all.
+
+        Devices and flows call this once at setup and skip disabled events
+        at the source.
+
+        Args:
+            kind: Event kind.
+            entities: Leading event arguments identifying the source.
+        """
+        if self.selection is None:
+            return True
+        for metric, k, pos in METRICS:
+            if k == kind and pos < len(entities) and \
+               entities[pos] in self.selection.get(metric, ()):
+                return True
+        return False
+
+    def emit(self, kind, now, *args):
+        """Records one event.
+
+        Args:
+            kind: Event kind, one of the names in EVENTS.
+            now: Simulation time of the event.
+            args: Event arguments in the order given by the text format.
+        """
+        raise NotImplementedError()
+
+    def comment(self, text=''):
+        """Records a header line such as an output selection."""
+        pass
+
+    def flush(self):
+        """Writes out buffered events."""
+        pass
+
+    def close(self):
+        """Flushes and releases the underlying stream."""
+        self.flush()
+
+class NullTracer(Tracer):
+    """Discards every event."""
+
+    def emit(self, kind, now, *args):
+        pass
+
+class TextTracer(Tracer):
+    """Writes events as text lines, one per event.
+
+    This is the log format consumed by process.py.
+    """
+
+    def __init__(self, stream=None):
+        self.stream = stream if stream is not None else sys.stdout
+        self._formats = dict((e[0], e[1] + '\n') for e in EVENTS)
+
+    def emit(self, kind, now, *args):
+        self.stream.write(self._formats[kind].format(now, *args))
+
+    def comment(self, text=''):
+        self.stream.write('# ' + text + '\n' if text else '#\n')
+
+    def flush(self):
+        self.stream.flush()
+
+_MAGIC = b'NSTRACE\x01'
+_UINT = struct.Struct('<I')
+_TYPECODES = {'e': 'I', 'i': 'i', 'f': 'd'}
+
+class BinaryTracer(Tracer):
+    """Writes events as fixed-width records in columnar blocks.
+
+    The stream starts with a magic string followed by chunks. Each chunk is
+    a one-byte tag and a little-endian uint32 count:
+
+        b'H': one header line of <count> UTF-8 bytes.
+        b'N': <count> newly interned names, each a uint32 length and bytes.
+              Names are numbered consecutively from 0 in order of appearance.
+        b'R': <count> event records. The event codes (uint8) come first and
+              fix the order of the records. Then, for every event kind in
+              EVENTS order, the columns of its records: time (float64) and
+              one column per schema letter, entity ids as uint32, integers
+              as int32 and reals as float64.
+
+    All columns are little-endian.
+
+    Attributes:
+        block_size: Number of records buffered before a block is written.
+    """
+
+    def __init__(self, stream, block_size=1 << 16):
+        self.stream = stream
+        self.block_size = block_size
+        self._names = {}
+        self._new_names = []
+        self._records = []
+        self.stream.write(_MAGIC)
+
+    def _intern(self, name):
+        try:
+            return self._names[name]
+        except KeyError:
+            i = self._names[name] = len(self._names)
+            self._new_names.append(name)
+            return i
+
+    def emit(self, kind, now, *args):
+        records = self._records
+        records.append((EVENT_CODES[kind], now, args))
+        if len(records) >= self.block_size:
+            self._write_block()
+
+    def comment(self, text=''):
+        self._write_block()
+        data = text.encode('utf-8')
+        self.stream.write(b'H' + _UINT.pack(len(data)) + data)
+
+    def _write_block(self):
+        write = self.stream.write
+        records = self._records
+        if not records:
+            return
+        self._records = []
+
+        # Split records by kind and convert them into columns
+        codes = array('B', [r[0] for r in records])
+        by_kind = [[] for _ in EVENTS]
+        for r in records:
+            by_kind[r[0]].append(r)
+
+        columns = []
+        for (_, _, schema), recs in zip(EVENTS, by_kind):
+            columns.append(array('d', [r[1] for r in recs]))
+            for j, t in enumerate(schema):
+                if t == 'e':
+                    col = [self._intern(r[2][j]) for r in recs]
+                else:
+                    col = [r[2][j] for r in recs]
+                columns.append(array(_TYPECODES[t], col))
+
+        if self._new_names:
+            write(b'N' + _UINT.pack(len(self._new_names)))
+            for name in self._new_names:
+                data = str(name).encode('utf-8')
+                write(_UINT.pack(len(data)) + data)
+            self._new_names = []
+
+        write(b'R' + _UINT.pack(len(codes)))
+        for col in [codes] + columns:
+            if sys.byteorder == 'big':
+                col.byteswap()
+            write(_tobytes(col))
+
+    def flush(self):
+        self._write_block()
+        self.stream.flush()
+
+def _tobytes(a):
+    return a.tobytes() if hasattr(a, 'tobytes') else a.tostring()
+
+def _read_array(stream, typecode, n):
+    a = array(typecode)
+    data = stream.read(a.itemsize * n)
+    if hasattr(a, 'frombytes'):
+        a.frombytes(data)
+    else:
+        a.fromstring(data)
+    if sys.byteorder == 'big':
+        a.byteswap()
+    return a
+
+def replay(stream, tracer):
+    """Feeds the events of a binary trace into another tracer.
+
+    Args:
+        stream: Binary file object produced by BinaryTracer.
+        tracer: Tracer receiving the decoded events.
+    """
+    if stream.read(len(_MAGIC)) != _MAGIC:
+        raise Exception('Not a binary trace')
+
+    names = []
+    while True:
+        tag = stream.read(1)
+        if not tag:
+            break
+        n, = _UINT.unpack(stream.read(_UINT.size))
+        if tag == b'H':
+            tracer.comment(stream.read(n).decode('utf-8'))
+        elif tag == b'N':
+            for _ in range(n):
+                size, = _UINT.unpack(stream.read(_UINT.size))
+                names.append(stream.read(size).decode('utf-8'))
+        elif tag == b'R':
+            codes = _read_array(stream, 'B', n)
+            counts = [0] * len(EVENTS)
+            for c in codes:
+                counts[c] += 1
+
+            # Rebuild the records of each kind as argument tuples
+            records = []
+            for (kind, _, schema), m in zip(EVENTS, counts):
+                time = _read_array(stream, 'd', m)
+                cols = []
+                for t in schema:
+                    col = _read_array(stream, _TYPECODES[t], m)
+                    if t == 'e':
+                        col = [names[k] for k in col]
+                    cols.append(col)
+                records.append(iter(zip(time, *cols)))
+
+            for c in codes:
+                rec = next(records[c])
+                tracer.emit(EVENTS[c][0], *rec)
+        else:
+            raise Exception('Corrupted binary trace')
+    tracer.flush()
+
+if __name__ == '__main__':
+    # Convert a binary trace on stdin to the text log format on stdout.
+    stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+    replay(stdin, TextTracer(sys.stdout))